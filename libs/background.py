@@ -0,0 +1,113 @@
+"""In this file I define the functions used to mix pre-simulated dark counts into events."""
+from libs.lib import *
+from libs.cache import cachePath, saveCache, loadCache
+from concurrent.futures import ThreadPoolExecutor
+from libs.kernels import generator, seedThread
+
+##@cond
+bkglibrary = None
+##@endcond
+
+## Version of the library format, changing it invalidates cached libraries.
+BKGVERSION = 2
+
+
+def generateBackground(nevents):
+    """!@brief Generation of a library of dark-only events."""
+    """!
+    Simulates nevents events without photons using the same DCR, XT and AP
+    physics used in the full simulation. Pulse lists of all the events are
+    stored in ragged arrays: the pulses of the i-th event are in the range
+    offsets[i]:offsets[i+1]. The random generators of the calling thread are
+    seeded with @ref variables.BKGSEED, so the library is the same on every
+    host (e.g. shards with separate cache directories). It is run on a
+    thread of its own by @ref backgroundLibrary, so the random streams of
+    the caller are left untouched.
+    @param nevents:     Number of dark-only events to simulate.
+    @return library:    Dictionary containing times, heights, cell IDs,
+                        origin flags, offsets and the number of DCR, XT and
+                        AP pulses of each event.
+    """
+
+    seedThread(BKGSEED)
+    times = []
+    heights = []
+    cells = []
+    origins = []
+    offsets = np.zeros(nevents + 1, dtype=np.int64)
+    counts = np.zeros((nevents, 3), dtype=np.int32)
+
+    for i in range(nevents):
+        t, ndcr = addDCR(DCR)
+        nxt = 0
+        nap = 0
+        idx = DarkCells(ndcr)
+        if not args.noxt:
+            t, idx, nxt = addXT(t, idx, XT)
+        origin = [DARK] * ndcr + [CROSSTALK] * nxt
+        t, idx, origin = sortPulses(t, idx, origin)
+        t, h = SiPMEventAction(t, idx)
+        if not args.noap:
+            t, h, nap = addAP(t, h, AP, idx)
+            origin.extend([AFTERPULSE] * nap)
+
+        times.extend(t)
+        heights.extend(h)
+        cells.extend(idx)
+        origins.extend(origin)
+        offsets[i + 1] = offsets[i] + len(t)
+        counts[i] = ndcr, nxt, nap
+
+    return {'times': np.asarray(times, dtype=np.float32),
+            'heights': np.asarray(heights, dtype=np.float32),
+            'cells': np.asarray(cells, dtype=np.int32),
+            'origin': np.asarray(origins, dtype=np.int8),
+            'offsets': offsets,
+            'counts': counts}
+
+
+def backgroundLibrary():
+    """!@brief Returns the background library loading or generating it on first use."""
+    """!
+    The library is cached in @ref variables.CACHEDIR with a name depending on
+    the sensor settings (and on the hot cells, if any), so it is generated
+    only once for each configuration.
+    """
+
+    global bkglibrary
+    if bkglibrary is None:
+        # Dark counts of hot cells depend on the cell maps
+        hot = (CELLSEED, HOTCELLS, HOTFACTOR) if cells is not None and cells.dark is not None else ()
+        fname = cachePath('background', BKGSIZE, BKGSEED, args.noxt, args.noap, BKGVERSION, *hot)
+        bkglibrary = loadCache(fname)
+        if bkglibrary is None:
+            print(f'Generating background library of {BKGSIZE:d} events in {fname:s}...')
+            with ThreadPoolExecutor(1) as pool:
+                bkglibrary = pool.submit(generateBackground, BKGSIZE).result()
+            saveCache(fname, **bkglibrary)
+    return bkglibrary
+
+
+def darkBackground():
+    """!@brief Dark pulses of a single event taken from the background library."""
+    """!
+    A random event of the library is shifted circularly by a random time in
+    the signal window. Cell recovery between dark pulses and photon pulses is
+    not considered, this is a good approximation as long as the occupancy of
+    the SiPM is small.
+    @return times:  Array containing the times of the dark pulses.
+    @return h:      Array containing the relative height of the dark pulses.
+    @return cells:  Array containing the cell IDs of the dark pulses.
+    @return origin: Array containing the origin flags of the dark pulses.
+    @return counts: Number of DCR, XT and AP pulses.
+    """
+
+    bkg = backgroundLibrary()
+    rng = generator()
+    i = rng.integers(BKGSIZE)
+    start, stop = bkg['offsets'][i:i + 2]
+
+    times = bkg['times'][start:stop] + rng.uniform(0, SIGLEN)
+    times[times >= SIGLEN] -= SIGLEN
+    return (times, bkg['heights'][start:stop], bkg['cells'][start:stop],
+            bkg['origin'][start:stop], bkg['counts'][i])
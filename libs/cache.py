@@ -0,0 +1,71 @@
+"""In this file I define the functions used to store precomputed tables on disk."""
+import hashlib
+import variables
+from variables import *
+
+## Names of the settings that define a SiPM sensor configuration.
+SENSORSETTINGS = ('SIGLEN', 'SAMPLING', 'SIZE', 'CELLSIZE', 'DCR', 'XT', 'AP',
+                  'TFALL', 'TRISE', 'CELLRECOVERY', 'TAUAPFAST', 'TAUAPSLOW',
+                  'SNR', 'BASESPREAD', 'CCGV')
+
+
+def configHash(names=SENSORSETTINGS, *extra):
+    """!@brief Hash of the current configuration."""
+    """!
+    Computes a short hash of the current values of the settings listed in
+    names. Any other value that affects the cached table (e.g. the table size
+    or command line flags) can be passed as extra argument.
+    @param names:   Names of the settings defined in @ref variables.
+    @param extra:   Other values to include in the hash.
+    @return hash:   String containing the hexadecimal hash.
+    """
+
+    h = hashlib.sha1()
+    for name in names:
+        h.update(f'{name}={getattr(variables, name)!r};'.encode())
+    for e in extra:
+        h.update(f'{e!r};'.encode())
+    return h.hexdigest()[:16]
+
+
+def cachePath(kind, *extra, names=SENSORSETTINGS, ext='npz'):
+    """!@brief Path of a cached table."""
+    """!
+    @param kind:    Kind of table (used as prefix of the file name).
+    @param extra:   Other values to include in the hash.
+    @param names:   Names of the settings that define the table.
+    @param ext:     File extension.
+    @return path:   Path of the file in @ref variables.CACHEDIR.
+    """
+
+    return os.path.join(CACHEDIR, f'{kind:s}_{configHash(names, *extra):s}.{ext:s}')
+
+
+def saveCache(path, **arrays):
+    """!@brief Saves arrays in a cache file."""
+    """!
+    Arrays are first written on a temporary file and then moved in place, so
+    workers building the same table at the same time never read a partially
+    written file.
+    @param path:    Path of the cache file (.npz).
+    @param arrays:  Arrays to be saved.
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path:s}.{os.getpid():d}.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def loadCache(path):
+    """!@brief Loads arrays from a cache file."""
+    """!
+    @param path:    Path of the cache file (.npz).
+    @return arrays: Dictionary containing the arrays or None if the file
+                    does not exist.
+    """
+
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
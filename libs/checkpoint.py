@@ -0,0 +1,152 @@
+"""In this file I define the functions used to store completed chunks of events and to resume interrupted simulations."""
+import hashlib
+import json
+import pickle
+from variables import *
+from libs.cache import configHash
+from libs.replay import REPLAYSETTINGS
+
+## Names of the settings that must not change when a simulation is resumed.
+CHECKPOINTSETTINGS = REPLAYSETTINGS + ('INTSTART', 'INTGATE', 'THRESHOLD', 'GATES', 'BKGLIBRARY',
+                                       'BKGSIZE', 'BKGSEED', 'HITMAP', 'SPOTSIGMA', 'SPOTX', 'SPOTY',
+                                       'HOTCELLS', 'HOTFACTOR', 'EVENTRATE')
+
+
+def inputHash(times):
+    """!@brief Hash of the photon times of all the events."""
+    """!
+    @param times:   List containing the photon times of each event.
+    @return hash:   String containing the hexadecimal hash.
+    """
+
+    h = hashlib.sha1()
+    for t in times:
+        h.update(np.asarray(t, dtype=np.float64).tobytes())
+        h.update(b';')
+    return h.hexdigest()[:16]
+
+
+def checkpointManifest(times, seed, first):
+    """!@brief Description of a simulation stored in its checkpoint directory."""
+    """!
+    @param times:   List containing the photon times of each event.
+    @param seed:    Global seed of the simulation.
+    @param first:   Index of the first event in the whole production.
+    @return manifest: Dictionary describing the simulation.
+    """
+
+    return {'Seed': seed,
+            'ChunkSize': CHUNKSIZE,
+            'FirstEvent': first,
+            'NEvents': len(times),
+            'ConfigHash': configHash(CHECKPOINTSETTINGS, args.nodcr, args.noxt, args.noap),
+            'InputHash': inputHash(times)}
+
+
+def chunkPath(path, chunk):
+    """!@brief Name of the file containing a completed chunk."""
+    return os.path.join(path, f'chunk_{chunk:08d}.pkl')
+
+
+def checkpointSeed(path):
+    """!@brief Seed of the simulation stored in a checkpoint directory."""
+    """!
+    @param path:    Checkpoint directory.
+    @return seed:   Global seed of the simulation or None if the directory
+                    does not contain a checkpoint.
+    """
+
+    fname = os.path.join(path, 'manifest.json')
+    if not os.path.isfile(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)['Seed']
+
+
+def openCheckpoint(path, times, seed, first, resume=False):
+    """!@brief Opens the checkpoint directory of a simulation."""
+    """!
+    A new simulation writes its manifest in the directory, which must not
+    already contain one. A resumed simulation checks that seed, chunk size,
+    settings and input events are the same of the interrupted one and loads
+    its completed chunks. Since every chunk reseeds all the random
+    generators from the global seed and its index, the seed stored in the
+    manifest is all the random state needed to resume.
+    @param path:    Checkpoint directory.
+    @param times:   List containing the photon times of each event.
+    @param seed:    Global seed of the simulation, if None the seed of the
+                    interrupted simulation is used (or a new one is taken
+                    from the operating system entropy pool).
+    @param first:   Index of the first event in the whole production.
+    @param resume:  If True completed chunks are loaded.
+    @return seed:   Global seed of the simulation.
+    @return done:   Dictionary containing the results of each completed
+                    chunk, indexed by chunk number.
+    """
+
+    fname = os.path.join(path, 'manifest.json')
+    if os.path.isfile(fname):
+        if not resume:
+            raise FileExistsError(f'{path:s} already contains a checkpoint, use --resume to continue it')
+        with open(fname) as f:
+            old = json.load(f)
+        if seed is None:
+            seed = old['Seed']
+        manifest = checkpointManifest(times, seed, first)
+        changed = [k for k in manifest if manifest[k] != old[k]]
+        if changed:
+            raise ValueError(f'Unable to resume from {path:s}, changed: ' + ', '.join(changed))
+    else:
+        if resume:
+            print(f'No checkpoint found in {path:s}, starting a new simulation')
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), "big")
+        os.makedirs(path, exist_ok=True)
+        manifest = checkpointManifest(times, seed, first)
+        tmp = f'{fname:s}.{os.getpid():d}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, fname)
+
+    done = {}
+    for chunk in [(first + i) // CHUNKSIZE for i in range(0, len(times), CHUNKSIZE)]:
+        if os.path.isfile(chunkPath(path, chunk)):
+            with open(chunkPath(path, chunk), 'rb') as f:
+                done[chunk] = pickle.load(f)
+    if done:
+        print(f'Resuming from {path:s}: {len(done):d} chunks already simulated')
+    return seed, done
+
+
+def chunkResults(results):
+    """!@brief Results of a chunk in the form stored in the checkpoint directory."""
+    """!
+    Waveforms take most of the space of the results: they are dropped if
+    they are not written (-W), otherwise they are kept as float32, the type
+    used by @ref lib.SaveWaves.
+    @param results: List containing the output of @ref sipm.SiPM for each
+                    event of the chunk.
+    @return results: List containing the results to be stored.
+    """
+
+    if args.wavedump is None:
+        return [r[:2] + (None,) + r[3:] for r in results]
+    return [r[:2] + (np.asarray(r[2], dtype=np.float32),) + r[3:] for r in results]
+
+
+def saveChunk(path, chunk, results):
+    """!@brief Stores the results of a completed chunk."""
+    """!
+    Results are first written on a temporary file and then moved in place, so
+    an interrupted write never leaves a corrupted chunk.
+    @param path:    Checkpoint directory.
+    @param chunk:   Index of the chunk.
+    @param results: List containing the results of each event of the chunk
+                    returned by @ref chunkResults.
+    """
+
+    fname = chunkPath(path, chunk)
+    tmp = f'{fname:s}.{os.getpid():d}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fname)
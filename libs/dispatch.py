@@ -0,0 +1,158 @@
+"""In this file I define the functions used to choose the fastest signal generation strategy for each event."""
+import platform
+from variables import *
+from libs.cache import cachePath, saveCache, loadCache
+froll, fsignal = kernels.froll, kernels.fsignal
+
+## Number of hitted cells at which strategies are benchmarked.
+DISPATCHGRID = np.array([1, 3, 10, 30, 100, 300, 1000, 3000, 10000])
+
+## Signal generated by a single photoelectron at time 0.
+dispatchmodel = fsignal(0, TF, TR, PEAKRATIO, SIGPTS)
+
+## Length of the FFT used by the convolution strategy (no circular aliasing).
+NFFT = 1 << int(np.ceil(np.log2(2 * SIGPTS)))
+
+## FFT of the single photoelectron signal.
+dispatchmodelfft = np.fft.rfft(dispatchmodel, NFFT)
+
+
+def rollStrategy(times, h):
+    """!@brief Moves the precomputed signal shape for each pulse (froll)."""
+    signal = np.zeros(SIGPTS)
+    for i in range(times.size):
+        signal += froll(dispatchmodel, times[i], h[i])
+    return signal
+
+
+def fullStrategy(times, h):
+    """!@brief Computes the full signal shape for each pulse (fsignal)."""
+    signal = np.zeros(SIGPTS)
+    for i in range(times.size):
+        signal += fsignal(times[i], TF, TR, h[i] * PEAKRATIO, SIGPTS)
+    return signal
+
+
+def convolutionStrategy(times, h):
+    """!@brief Convolves the train of pulses with the signal shape."""
+    """!
+    Pulse heights are summed in a sampled train with a single bincount and
+    the train is convolved with the signal shape via FFT. The cost does not
+    depend on the number of pulses.
+    """
+    train = np.bincount(times, weights=h, minlength=SIGPTS)
+    return np.fft.irfft(np.fft.rfft(train, NFFT) * dispatchmodelfft, NFFT)[:SIGPTS]
+
+
+def gpuStrategy(times, h):
+    """!@brief Generates all the pulses at once on GPU."""
+    from libs.libGPU import PulseGPU
+    return cp.asnumpy(PulseGPU(cp.asarray(times), cp.asarray(h, dtype=cp.float32)))
+
+
+def dispatchStrategies():
+    """!@brief Strategies available on this host."""
+    """!
+    @return strategies: Dictionary containing the name and the function of
+                        each strategy.
+    """
+
+    strategies = {'roll': rollStrategy,
+                  'full': fullStrategy,
+                  'convolution': convolutionStrategy}
+    if args.device == 'gpu':
+        strategies['gpu'] = gpuStrategy
+    return strategies
+
+
+def calibrateDispatch(strategies, reps=5):
+    """!@brief Benchmarks each strategy with the current settings."""
+    """!
+    Each strategy is timed (best of reps runs) with a growing number of
+    random pulses given by @ref DISPATCHGRID. Once a strategy becomes 20
+    times slower than the best one it is not timed anymore for larger
+    numbers of pulses.
+    @param strategies:  Dictionary returned by @ref dispatchStrategies.
+    @param reps:        Number of runs for each measurement.
+    @return cost:       Array of shape (nstrategies, ngrid) containing the
+                        time in seconds of each strategy.
+    """
+
+    cost = np.full((len(strategies), DISPATCHGRID.size), np.inf)
+    rng = np.random.default_rng(0)
+    for j, n in enumerate(DISPATCHGRID):
+        times = rng.integers(0, SIGPTS, n).astype(np.uint32)
+        h = np.ones(n)
+        for i, f in enumerate(strategies.values()):
+            if j and cost[i, j - 1] > 20 * cost[:, j - 1].min():
+                continue
+            best = np.inf
+            for r in range(reps):
+                start = time.perf_counter()
+                f(times, h)
+                best = min(best, time.perf_counter() - start)
+            cost[i, j] = best
+    return cost
+
+
+def dispatchTable():
+    """!@brief Returns the strategy to use for each grid point."""
+    """!
+    The benchmark is run once for each host, kernels backend and
+    configuration and its results are cached in @ref variables.CACHEDIR.
+    @return names:  Array containing the name of the fastest strategy for
+                    each point of @ref DISPATCHGRID.
+    @return cpu:    Array containing the name of the fastest strategy running
+                    on CPU for each point of @ref DISPATCHGRID.
+    """
+
+    strategies = dispatchStrategies()
+    fname = cachePath('dispatch', platform.node(), kernels.name, tuple(strategies), DISPATCHGRID.tolist(),
+                      names=('SIGLEN', 'SAMPLING', 'TFALL', 'TRISE'))
+    table = loadCache(fname)
+    if table is None:
+        print(f'Benchmarking signal generation strategies on {platform.node():s}...')
+        cost = calibrateDispatch(strategies)
+        table = {'names': np.array(list(strategies)), 'cost': cost}
+        saveCache(fname, **table)
+    best = table['cost'].argmin(axis=0)
+    for n, i in zip(DISPATCHGRID, best):
+        print(f'{n:6d} pulses -> {table["names"][i]:s}')
+    cost = np.where((table['names'] == 'gpu')[:, None], np.inf, table['cost'])
+    return table['names'][best], table['names'][cost.argmin(axis=0)]
+
+
+## Upper edges (geometric mean between grid points) used to select a strategy.
+DISPATCHEDGES = np.sqrt(DISPATCHGRID[:-1] * DISPATCHGRID[1:])
+
+if DISPATCH:
+    ## Name of the fastest strategy (and of the fastest one on CPU) for each
+    ## point of @ref DISPATCHGRID.
+    dispatchbest, dispatchcpu = dispatchTable()
+    dispatchfunctions = dispatchStrategies()
+
+
+def chooseStrategy(n):
+    """!@brief Name of the fastest strategy for n pulses."""
+    """!
+    The GPU is used only between @ref variables.CPUTHRESHOLD and
+    @ref variables.GPUMAX pulses and inside the calibrated range, so large
+    events never run out of GPU memory. Otherwise the fastest strategy on
+    CPU is used.
+    """
+    i = np.searchsorted(DISPATCHEDGES, n)
+    if dispatchbest[i] == 'gpu' and (n < CPUTHRESHOLD or n > min(GPUMAX, DISPATCHGRID[-1])):
+        return dispatchcpu[i]
+    return dispatchbest[i]
+
+
+def synthesize(times, h):
+    """!@brief Generates the sum of the pulses with the fastest strategy."""
+    """!
+    @param times:   Array containing the time of each pulse in units of
+                    samples.
+    @param h:       Array containing the height of each pulse.
+    @return signal: Array containing the sum of the pulses.
+    """
+
+    return dispatchfunctions[chooseStrategy(times.size)](times, h)
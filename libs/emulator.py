@@ -0,0 +1,243 @@
+"""In this file I define the functions used to emulate SiPM features from precomputed tables."""
+import math
+from variables import *
+from libs.cache import cachePath, saveCache, loadCache
+from libs.checkpoint import CHECKPOINTSETTINGS
+from libs.kernels import generator
+
+## Names of the features, in the same order as returned by @ref sipm.SiPM.
+FEATURES = ('Peak', 'Integral', 'ToA', 'ToT', 'ToP')
+
+## Names of the settings that define an emulator table: all the settings
+## changing the simulated events except the additional gates, which are not
+## emulated.
+EMULATORSETTINGS = tuple(name for name in CHECKPOINTSETTINGS if name != 'GATES')
+
+## Normal scores at which the quantiles of the features are tabulated.
+ZGRID = np.linspace(-4, 4, 161)
+
+## Cumulative probability of each normal score in @ref ZGRID.
+LEVELS = np.array([0.5 * (1 + math.erf(z / math.sqrt(2))) for z in ZGRID])
+
+## Version of the table format, changing it invalidates cached tables.
+EMULATORVERSION = 2
+
+
+def gateTimes(n):
+    """!@brief Default arrival time of photons used to build the tables."""
+    """!
+    All photons arrive 1 ns after the start of the integration gate.
+    @param n:       Number of photons.
+    @return times:  List containing the arrival times in ns.
+    """
+
+    return [INTSTART * SAMPLING + 1] * n
+
+
+def simulateFeatures(npe, nevents, timegen=gateTimes, pool=None):
+    """!@brief Features of nevents events with npe photons from the full simulation."""
+    """!
+    @param npe:         Number of photons of each event.
+    @param nevents:     Number of events to simulate.
+    @param timegen:     Function returning the arrival times of n photons.
+    @param pool:        Optional multiprocessing Pool used to run the events.
+    @return features:   Array of shape (nevents, 5).
+    """
+
+    from sipm import SiPM
+
+    times = [timegen(int(npe)) for i in range(nevents)]
+    if pool is None:
+        results = [SiPM(t) for t in times]
+    else:
+        results = pool.map(SiPM, times)
+    return np.array([r[0] for r in results], dtype=np.float64)
+
+
+def copulaCholesky(features):
+    """!@brief Correlation of the features as a gaussian copula."""
+    """!
+    The Spearman correlation of the features is converted into the
+    correlation of a gaussian copula, @f$\\rho=2\\sin(\\pi\\rho_s/6)@f$, and
+    its Cholesky factor is returned. Constant features are left
+    uncorrelated.
+    @param features:    Array of shape (nevents, nfeatures).
+    @return L:          Lower triangular Cholesky factor.
+    """
+
+    ranks = features.argsort(axis=0).argsort(axis=0).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = np.corrcoef(ranks, rowvar=False)
+    rho = np.nan_to_num(2 * np.sin(np.pi * rho / 6))
+    np.fill_diagonal(rho, 1)
+    # Force the matrix to be positive definite
+    w, v = np.linalg.eigh(rho)
+    rho = (v * np.clip(w, 1e-6, None)) @ v.T
+    d = np.sqrt(np.diag(rho))
+    return np.linalg.cholesky(rho / np.outer(d, d))
+
+
+def buildEmulator(npegrid, nevents, timegen=gateTimes, pool=None):
+    """!@brief Builds the emulator tables running the full simulation."""
+    """!
+    For each number of photons in npegrid nevents events are simulated.
+    The probability that the signal stays below the threshold (all the
+    features set to -1) is stored separately. For the other events the
+    conditional distribution of each feature is stored as a table of
+    quantiles at the normal scores @ref ZGRID, the correlation between the
+    features is stored as a gaussian copula. Grid points without events over
+    the threshold take the tables of the closest point that has them.
+    @param npegrid:     Increasing array containing the number of photons.
+    @param nevents:     Number of events simulated for each grid point.
+    @param timegen:     Function returning the arrival times of n photons.
+    @param pool:        Optional multiprocessing Pool used to run the events.
+    @return table:      Dictionary containing the tables.
+    """
+
+    npegrid = np.asarray(npegrid, dtype=np.float64)
+    quantiles = np.full((npegrid.size, len(FEATURES), ZGRID.size), -1.)
+    cholesky = np.tile(np.eye(len(FEATURES)), (npegrid.size, 1, 1))
+    below = np.empty(npegrid.size)
+
+    for i, npe in enumerate(npegrid):
+        print(f'Building emulator table: {npe:.0f} photons ({i + 1:d}/{npegrid.size:d})\r', end='')
+        features = simulateFeatures(npe, nevents, timegen, pool)
+        valid = ~np.all(features == -1, axis=1)
+        below[i] = 1 - valid.mean()
+        if valid.any():
+            quantiles[i] = np.quantile(features[valid], LEVELS, axis=0).T
+            cholesky[i] = copulaCholesky(features[valid])
+    print()
+
+    # Grid points where no event is over the threshold
+    filled = np.flatnonzero(below < 1)
+    if filled.size:
+        nearest = filled[np.abs(np.arange(npegrid.size)[:, None] - filled[None, :]).argmin(axis=1)]
+        quantiles = quantiles[nearest]
+        cholesky = cholesky[nearest]
+
+    return {'npe': npegrid, 'zgrid': ZGRID, 'quantiles': quantiles, 'cholesky': cholesky, 'below': below}
+
+
+def emulateFeatures(npe, table):
+    """!@brief Draws features for an array of number of photons."""
+    """!
+    Features are drawn from the gaussian copula of the closest grid point
+    and transformed with the tabulated quantiles. Quantiles and the
+    probability of staying below the threshold are linearly interpolated
+    between grid points, numbers of photons outside the grid are clipped to
+    its limits. The lowest peaks are the ones below the threshold: the
+    events whose peak falls in the first @f$p_{below}@f$ of the distribution
+    get all the features set to -1, the peak of the others is taken from the
+    rest of the distribution. Times are rounded to multiples of
+    @ref variables.SAMPLING as in the full simulation. Everything is
+    vectorized so the cost does not depend on the number of photons.
+    @param npe:         Array containing the number of photons of each event.
+    @param table:       Dictionary returned by @ref buildEmulator.
+    @return features:   Array of shape (npe.size, 5).
+    """
+
+    npe = np.asarray(npe, dtype=np.float64).ravel()
+    grid = table['npe']
+    zgrid = table['zgrid']
+    q = table['quantiles']
+    nfeat = q.shape[1]
+
+    # Position in the npe grid
+    pos = np.interp(npe, grid, np.arange(grid.size, dtype=np.float64))
+    g0 = np.minimum(pos.astype(np.int64), grid.size - 1)
+    g1 = np.minimum(g0 + 1, grid.size - 1)
+    wg = (pos - g0)[:, None]
+
+    # Correlated normal scores
+    z = np.einsum('nij,nj->ni', table['cholesky'][np.rint(pos).astype(np.int64)],
+                  generator().standard_normal((npe.size, nfeat)))
+
+    # Position in the normal scores grid
+    k = np.clip((z - zgrid[0]) / (zgrid[1] - zgrid[0]), 0, zgrid.size - 1)
+
+    # Events below the threshold and peak of the others
+    pbelow = np.interp(npe, grid, table['below'])
+    u = np.interp(k[:, 0], np.arange(zgrid.size), LEVELS)
+    below = u < pbelow
+    with np.errstate(invalid='ignore', divide='ignore'):
+        u = np.clip((u - pbelow) / (1 - pbelow), LEVELS[0], LEVELS[-1])
+    k[:, 0] = np.interp(u, LEVELS, np.arange(zgrid.size))
+
+    k0 = np.minimum(k.astype(np.int64), zgrid.size - 2)
+    wk = k - k0
+    f = np.arange(nfeat)[None, :]
+
+    def lookup(g):
+        return q[g[:, None], f, k0] * (1 - wk) + q[g[:, None], f, k0 + 1] * wk
+
+    features = lookup(g0) * (1 - wg) + lookup(g1) * wg
+    times = [FEATURES.index(name) for name in ('ToA', 'ToT', 'ToP')]
+    features[:, times] = np.rint(features[:, times] / SAMPLING) * SAMPLING
+    features[below] = -1
+    return features
+
+
+def emulatorReport(table, npecheck, nevents, timegen=gateTimes, pool=None):
+    """!@brief Accuracy of the emulator compared with the full simulation."""
+    """!
+    For each number of photons in npecheck the full simulation and the
+    emulator are run and the mean value, the standard deviation and the
+    correlation of the features are compared.
+    @param table:       Dictionary returned by @ref buildEmulator.
+    @param npecheck:    Array containing the number of photons to check.
+    @param nevents:     Number of events for each check.
+    @param timegen:     Function returning the arrival times of n photons.
+    @param pool:        Optional multiprocessing Pool used to run the events.
+    @return report:     Dictionary containing the relative difference of mean
+                        values and standard deviations and the maximum
+                        absolute difference of the correlation coefficients.
+    """
+
+    npecheck = np.asarray(npecheck, dtype=np.float64)
+    dmean = np.empty((npecheck.size, len(FEATURES)))
+    dstd = np.empty((npecheck.size, len(FEATURES)))
+    dcorr = np.empty(npecheck.size)
+
+    print('Emulator accuracy (relative difference of mean / std)')
+    print('npe\t' + '\t\t'.join(FEATURES) + '\t\tcorr')
+    for i, npe in enumerate(npecheck):
+        full = simulateFeatures(npe, nevents, timegen, pool)
+        fast = emulateFeatures(np.full(nevents, npe), table)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dmean[i] = (fast.mean(0) - full.mean(0)) / np.abs(full.mean(0))
+            dstd[i] = (fast.std(0) - full.std(0)) / full.std(0)
+            cfull = np.nan_to_num(np.corrcoef(full, rowvar=False))
+            cfast = np.nan_to_num(np.corrcoef(fast, rowvar=False))
+        dcorr[i] = np.abs(cfast - cfull).max()
+        line = '\t'.join(f'{m:+.3f}/{s:+.3f}' for m, s in zip(dmean[i], dstd[i]))
+        print(f'{npe:.0f}\t{line:s}\t{dcorr[i]:.3f}')
+
+    return {'report_npe': npecheck, 'report_mean': dmean, 'report_std': dstd, 'report_corr': dcorr}
+
+
+def emulatorTable(npegrid, nevents, timegen=gateTimes, pool=None):
+    """!@brief Returns the emulator table loading or building it."""
+    """!
+    Tables are cached in @ref variables.CACHEDIR with a name depending on
+    the settings, the npe grid and the number of events. When a table is
+    built its accuracy is checked halfway between grid points, where the
+    interpolation error is largest, and the report is stored in the table.
+    @param npegrid:     Increasing array containing the number of photons.
+    @param nevents:     Number of events simulated for each grid point.
+    @param timegen:     Function returning the arrival times of n photons.
+                        Custom functions are not part of the cache key.
+    @param pool:        Optional multiprocessing Pool used to run the events.
+    @return table:      Dictionary containing the tables and the report.
+    """
+
+    npegrid = np.asarray(npegrid, dtype=np.float64)
+    fname = cachePath('emulator', npegrid.tolist(), nevents, args.nodcr, args.noxt, args.noap,
+                      None if FASTSIG else args.device, EMULATORVERSION, names=EMULATORSETTINGS)
+    table = loadCache(fname)
+    if table is None:
+        table = buildEmulator(npegrid, nevents, timegen, pool)
+        npecheck = np.unique(np.rint(np.sqrt(npegrid[:-1] * npegrid[1:])))
+        table.update(emulatorReport(table, npecheck, nevents, timegen, pool))
+        saveCache(fname, **table)
+    return table
@@ -0,0 +1,139 @@
+"""In this file I define the functions used to generate cell IDs from non-uniform illumination maps."""
+import hashlib
+from variables import *
+from libs.cache import cachePath, saveCache, loadCache
+from libs.kernels import generator
+
+##@cond
+aliastables = {}
+##@endcond
+
+
+def aliasTable(weights):
+    """!@brief Generation of the alias table of a discrete distribution."""
+    """!
+    Builds the probability and alias arrays used by the alias method
+    (Vose's algorithm). Building the table costs O(N) where N is the number
+    of cells, sampling from the table costs O(1) for each draw.
+    @param weights: Array containing the (not normalized) probability of each
+                    cell.
+    @return prob:   Array containing the probability of keeping the cell.
+    @return alias:  Array containing the alias of each cell.
+    """
+
+    p = np.asarray(weights, dtype=np.float64).ravel()
+    if (p < 0).any() or p.sum() <= 0:
+        raise ValueError('Illumination map must be non-negative and not empty')
+    n = p.size
+    p = (p * n / p.sum()).tolist()
+    prob = np.ones(n)
+    alias = np.arange(n)
+
+    small = [i for i in range(n) if p[i] < 1]
+    large = [i for i in range(n) if p[i] >= 1]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = p[s]
+        alias[s] = l
+        p[l] = p[l] + p[s] - 1
+        if p[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+
+    return prob, alias
+
+
+def aliasSample(prob, alias, n):
+    """!@brief Draws n values from an alias table."""
+    """!
+    A single uniform random number is used for each draw: the integer part
+    selects the cell and the fractional part decides between the cell and
+    its alias.
+    @param prob:    Array containing the probability of keeping the cell.
+    @param alias:   Array containing the alias of each cell.
+    @param n:       Number of values to draw.
+    @return idx:    Array containing the drawn cell IDs.
+    """
+
+    u = generator().random(n) * prob.size
+    idx = u.astype(np.int64)
+    return np.where(u - idx < prob[idx], idx, alias[idx])
+
+
+def cachedAliasTable(weights):
+    """!@brief Alias table of a map, computed only once for each map."""
+    """!
+    Tables are kept in memory and stored in @ref variables.CACHEDIR, so the
+    setup cost is paid once even for very large maps.
+    @param weights: Array containing the (not normalized) map.
+    @return prob:   Array containing the probability of keeping the cell.
+    @return alias:  Array containing the alias of each cell.
+    """
+
+    weights = np.ascontiguousarray(weights, dtype=np.float64)
+    key = hashlib.sha1(weights.tobytes()).hexdigest()
+    if key not in aliastables:
+        fname = cachePath('alias', key, names=())
+        table = loadCache(fname)
+        if table is None:
+            prob, alias = aliasTable(weights)
+            saveCache(fname, prob=prob, alias=alias)
+        else:
+            prob, alias = table['prob'], table['alias']
+        aliastables[key] = prob, alias
+    return aliastables[key]
+
+
+def loadHitMap(fname):
+    """!@brief Reads an illumination map from file."""
+    """!
+    The map is a 2D array (.npy or text file) covering the whole sensor
+    surface. If its size differs from the number of cells on the side of the
+    sensor it is resampled on the cells grid.
+    @param fname:   Name of the file containing the map.
+    @return map:    Array of shape (CELLSIDE, CELLSIDE).
+    """
+
+    if fname.endswith('.npy'):
+        hmap = np.load(fname)
+    else:
+        hmap = np.loadtxt(fname, comments='#', ndmin=2)
+    rows = (np.arange(CELLSIDE) * hmap.shape[0]) // CELLSIDE
+    cols = (np.arange(CELLSIDE) * hmap.shape[1]) // CELLSIDE
+    return hmap[np.ix_(rows, cols)]
+
+
+def gaussianSpot(sigma, x0=0, y0=0):
+    """!@brief Illumination map of a gaussian light spot."""
+    """!
+    @param sigma:   Standard deviation of the spot in mm.
+    @param x0:      Horizontal offset of the spot from the center of the
+                    sensor in mm.
+    @param y0:      Vertical offset of the spot from the center of the
+                    sensor in mm.
+    @return map:    Array of shape (CELLSIDE, CELLSIDE).
+    """
+
+    # Coordinates of the center of each cell in mm
+    x = (np.arange(CELLSIDE) + 0.5) * CELLSIZE * 1e-3 - SIZE / 2
+    dx = (x - x0)**2
+    dy = (x - y0)**2
+    return exp(-(dy[:, None] + dx[None, :]) / (2 * sigma**2))
+
+
+def hitMap():
+    """!@brief Returns the illumination map set by the user."""
+    """!
+    The map is read from @ref variables.HITMAP if set, otherwise a gaussian
+    spot is used if @ref variables.SPOTSIGMA is set.
+    @return map:    Array containing the map or None if the illumination is
+                    uniform.
+    """
+
+    if HITMAP is not None:
+        return loadHitMap(HITMAP)
+    if SPOTSIGMA is not None:
+        return gaussianSpot(SPOTSIGMA, SPOTX, SPOTY)
+    return None
@@ -0,0 +1,286 @@
+"""In this file I define the backends (Fortran, NumPy, Numba) of the kernels used by the simulation.
+
+All backends share the same interface of the f2py module built from
+src/FortranFunctions.f90:
+    - fsignal(t, tf, tr, h, sigpts)
+    - froll(vect, t, h)
+    - fsort(array)  (in place)
+    - signalanalysisfortran(signalingate, sampling)
+    - frandom.integer(sup, n), frandom.normal(mu, sigma, n),
+      frandom.poisson(mu, n), frandom.exponential(mu, n)
+
+The equivalence of the available backends can be checked running:
+    python -m libs.kernels
+or with the tests in tests/test_kernels.py (make test).
+"""
+import hashlib
+import importlib.util
+import os
+import platform
+import subprocess
+import sys
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+##@cond
+backends = {}
+loaded = {}
+threadstate = threading.local()
+##@endcond
+
+## Backends in order of preference (fastest first).
+BACKENDORDER = ('fortran', 'numba', 'numpy')
+
+## Directory where the result of the test of the Fortran module is stored
+## (the default @ref variables.CACHEDIR, settings are not read by this module).
+PROBEDIR = os.path.join(os.path.expanduser('~'), '.cache', 'pySiPM')
+
+
+def registerBackend(name):
+    """!@brief Decorator registering the loader of a backend."""
+    """!
+    The loader must return a SimpleNamespace with the kernels or None if the
+    backend is not available on this host.
+    @param name:    Name of the backend.
+    """
+
+    def register(loader):
+        backends[name] = loader
+        return loader
+    return register
+
+
+@registerBackend('fortran')
+def fortranBackend():
+    """!@brief Kernels compiled from Fortran with f2py (make build)."""
+    """!
+    The module is compiled with -march=native, so a module built on another
+    host may crash the interpreter with an illegal instruction. The module
+    is therefore imported and run in a separate process before being used
+    for the first time on a host (@ref probeFortran).
+    The pulse kernels release the GIL (f2py threadsafe), the Fortran random
+    generator has a separate state for each thread.
+    """
+
+    spec = importlib.util.find_spec('libs.FortranFunctions')
+    if spec is None or not probeFortran(spec.origin):
+        return None
+
+    from libs import FortranFunctions as f
+    return SimpleNamespace(name='fortran',
+                           fsignal=f.fsignal,
+                           froll=f.froll,
+                           fsort=f.fsort,
+                           signalanalysisfortran=f.signalanalysisfortran,
+                           frandom=f.frandom)
+
+
+def probeFortran(origin):
+    """!@brief Tests the Fortran module in a separate process."""
+    """!
+    The result is stored in @ref PROBEDIR for each module file, host and
+    interpreter, so the test runs only once and not every time the settings
+    are loaded.
+    @param origin:  Path of the compiled module.
+    @return ok:     True if the module works on this host.
+    """
+
+    stat = os.stat(origin)
+    key = f'{origin:s};{stat.st_mtime_ns:d};{stat.st_size:d};{platform.node():s};{sys.executable:s}'
+    fname = os.path.join(PROBEDIR, f'fortran_{hashlib.sha1(key.encode()).hexdigest()[:16]:s}.probe')
+    if os.path.isfile(fname):
+        with open(fname) as f:
+            return f.read() == 'ok'
+
+    code = ('import libs.FortranFunctions as f;'
+            'f.fsignal(1, 50., 1., 1., 100); f.froll(f.fsignal(0, 50., 1., 1., 100), 1, 1.);'
+            'f.frandom.normal(0., 1., 10); f.frandom.poisson(1., 10)')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        probe = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, timeout=60)
+    except subprocess.TimeoutExpired:
+        return False    # Not stored, the host may just be busy
+    ok = probe.returncode == 0
+    if not ok:
+        print('Fortran kernels found but not working on this host')
+    try:
+        os.makedirs(PROBEDIR, exist_ok=True)
+        with open(fname, 'w') as f:
+            f.write('ok' if ok else 'failed')
+    except OSError:
+        pass
+    return ok
+
+
+def npsignal(t, tf, tr, h, sigpts):
+    """!@brief NumPy version of fsignal."""
+    s = np.zeros(sigpts)
+    i = np.arange(1, sigpts - t + 1)
+    s[t:] = np.exp(-i / tf) - np.exp(-i / tr)
+    return s * h
+
+
+def nproll(vect, t, h):
+    """!@brief NumPy version of froll."""
+    out = np.zeros(vect.size)
+    out[t:] = vect[:vect.size - t]
+    return out * h
+
+
+def npsort(array):
+    """!@brief NumPy version of fsort."""
+    array.sort()
+
+
+def npanalysis(signalingate, sampling):
+    """!@brief NumPy version of signalanalysisfortran."""
+    """!
+    As in the Fortran version positions are counted starting from 1 and the
+    time of arrival is 0 if the signal never exceeds 1.5.
+    """
+    mask = signalingate > 1.5
+    integral = signalingate.sum() * sampling
+    peak = signalingate.max()
+    toa = (mask.argmax() + 1) * sampling if mask.any() else 0.
+    tot = np.count_nonzero(mask) * sampling
+    top = (signalingate.argmax() + 1) * sampling
+    return integral, peak, toa, tot, top
+
+
+def generator():
+    """!@brief NumPy random generator of the calling thread."""
+    """!
+    Each thread has its own generator so threads never share a random
+    stream. The generator is seeded from the operating system entropy pool
+    unless @ref seedThread is called.
+    @return rng:    numpy.random.Generator of the thread.
+    """
+
+    if not hasattr(threadstate, 'rng'):
+        threadstate.rng = np.random.default_rng()
+    return threadstate.rng
+
+
+def seedThread(seed):
+    """!@brief Seeds the random generators of the calling thread."""
+    """!
+    Seeds the NumPy generator returned by @ref generator and the native
+    generator of the loaded backends that have one (Fortran).
+    @param seed:    Non-negative integer seed.
+    """
+
+    threadstate.rng = np.random.default_rng(seed)
+    for kernels in loaded.values():
+        if kernels is not None and hasattr(kernels.frandom, 'seed'):
+            kernels.frandom.seed(seed)
+
+
+## Random generation with the NumPy generator of the calling thread.
+nprandom = SimpleNamespace(integer=lambda sup, n: generator().integers(0, sup + 1, n),
+                           normal=lambda mu, sigma, n: generator().normal(mu, sigma, n),
+                           poisson=lambda mu, n: generator().poisson(mu, n),
+                           exponential=lambda mu, n: generator().exponential(mu, n))
+
+
+@registerBackend('numpy')
+def numpyBackend():
+    """!@brief Vectorized NumPy kernels, always available."""
+    return SimpleNamespace(name='numpy',
+                           fsignal=npsignal,
+                           froll=nproll,
+                           fsort=npsort,
+                           signalanalysisfortran=npanalysis,
+                           frandom=nprandom)
+
+
+@registerBackend('numba')
+def numbaBackend():
+    """!@brief NumPy kernels compiled at run time with Numba."""
+    """!
+    Kernels are compiled with nogil so they run in parallel in threads.
+    Random generation uses the NumPy backend.
+    """
+
+    if importlib.util.find_spec('numba') is None:
+        return None
+
+    import numba
+    return SimpleNamespace(name='numba',
+                           fsignal=numba.njit(cache=True, nogil=True)(npsignal),
+                           froll=numba.njit(cache=True, nogil=True)(nproll),
+                           fsort=numba.njit(cache=True, nogil=True)(npsort),
+                           signalanalysisfortran=npanalysis,
+                           frandom=nprandom)
+
+
+def loadBackend(name=None):
+    """!@brief Loads the kernels of a backend."""
+    """!
+    If name is None the fastest available backend is used, following
+    @ref BACKENDORDER. Backends are loaded only once.
+    @param name:    Name of the backend (fortran, numba, numpy) or None.
+    @return kernels: SimpleNamespace containing the kernels.
+    """
+
+    if name is None:
+        for n in BACKENDORDER:
+            kernels = loadBackend(n)
+            if kernels is not None:
+                return kernels
+    if name not in backends:
+        raise ValueError(f'Unknown backend {name}, choose between: {", ".join(backends)}')
+    if name not in loaded:
+        loaded[name] = backends[name]()
+    return loaded[name]
+
+
+def checkBackends(names=None):
+    """!@brief Checks that the available backends give the same results."""
+    """!
+    Deterministic kernels are compared with the NumPy backend, random
+    kernels are compared through the mean and variance of their output.
+    @param names:   Names of the backends to check, if None all registered
+                    backends are checked.
+    @return passed: True if all the checks are passed.
+    """
+
+    ref = loadBackend('numpy')
+    passed = True
+    sig = ref.fsignal(0, 50., 1., 1., 1000)
+    gate = np.random.default_rng(0).normal(0, 1, 500)
+    arr = np.random.default_rng(1).random(1000)
+    n = 200000
+
+    checks = {
+        'fsignal': lambda k: np.allclose(k.fsignal(7, 50., 1., 1.3, 1000), ref.fsignal(7, 50., 1., 1.3, 1000)),
+        'froll': lambda k: np.allclose(k.froll(sig, 13, 0.7), ref.froll(sig, 13, 0.7)),
+        'fsort': lambda k: np.array_equal(sortcopy(k, arr), np.sort(arr)),
+        'analysis': lambda k: np.allclose(k.signalanalysisfortran(gate, 0.1), ref.signalanalysisfortran(gate, 0.1)),
+        'integer': lambda k: abs(k.frandom.integer(9, n).mean() - 4.5) < 0.05,
+        'normal': lambda k: abs(k.frandom.normal(1., 2., n).std() - 2) < 0.02,
+        'poisson': lambda k: abs(k.frandom.poisson(0.3, n).mean() - 0.3) < 0.01,
+        'exponential': lambda k: abs(k.frandom.exponential(15., n).mean() - 15) < 0.2,
+    }
+
+    for name in names or backends:
+        kernels = loadBackend(name)
+        if kernels is None:
+            print(f'{name:8s} not available')
+            continue
+        failed = [c for c, f in checks.items() if not f(kernels)]
+        passed &= not failed
+        print(f'{name:8s} ' + ('OK' if not failed else 'FAILED: ' + ', '.join(failed)))
+    return passed
+
+
+def sortcopy(kernels, array):
+    """!@brief Sorts a copy of array with the kernels of a backend."""
+    array = array.copy()
+    kernels.fsort(array)
+    return array
+
+
+if __name__ == '__main__':
+    sys.exit(not checkBackends(sys.argv[1:] or None))
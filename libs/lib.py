@@ -1,7 +1,27 @@
 """In this file I define all the functions I will use in the main file of simulation."""
 from variables import *
-from libs.FortranFunctions import frandom
-from libs.FortranFunctions import froll, fsignal
+frandom, froll, fsignal = kernels.frandom, kernels.froll, kernels.fsignal
+from libs.noise import eventNoise
+from libs.hitmap import hitMap, cachedAliasTable, aliasSample
+from libs.dispatch import synthesize
+from libs.kernels import generator, seedThread
+from libs.sensor import cells, cellGain, cellHistory
+
+## Alias table of the illumination map (None if the illumination is uniform)
+illumination = hitMap()
+if illumination is not None:
+    illumination = cachedAliasTable(illumination)
+
+##@cond
+gatetables = {}
+##@endcond
+
+## Origin flags of the pulses (photon, dark count, crosstalk, afterpulse)
+PHOTON, DARK, CROSSTALK, AFTERPULSE = 0, 1, 2, 3
+
+## Names of the features of each gate, in the same order as returned by
+## @ref gateAnalysis.
+GATEFEATURES = ('Peak', 'Integral', 'ToA', 'ToT', 'ToP')
 
 def isinwindow(t):
     if t > 0 and t < SIGLEN:
@@ -43,11 +63,33 @@ def HitCells(n):
     Cell IDs are integers in range [0 - NCELLS] and are generated randomly.
     An ID can appear multiple times, meaning that the corresponding cell has
     generated an avalanche due to a photoelectron multiple times.
+    If an illumination map is set (@ref variables.HITMAP or
+    @ref variables.SPOTSIGMA) IDs are drawn from the map using the alias
+    method, otherwise generation is uniform.
     @param n:       Number of photoelectrons that have to be simulated.
     @return idx:    List containing the ID of each hitted cell.
     """
 
-    # At the moment generation is uniforms
+    if illumination is None:
+        idx = frandom.integer(NCELL, n).tolist()
+    else:
+        idx = aliasSample(*illumination, n).tolist()
+    return idx
+
+
+def DarkCells(n):
+    """!@brief Generation of cell IDs for dark count events."""
+    """!
+    Dark counts are not affected by the illumination map, hence their cell
+    IDs are generated uniformly unless there are hot cells in the cell maps
+    (@ref variables.HOTCELLS), in which case they are drawn from the dark
+    count map using the alias method.
+    @param n:       Number of dark count events.
+    @return idx:    List containing the ID of each hitted cell.
+    """
+
+    if cells is not None and cells.dark is not None:
+        return aliasSample(*cells.dark, n).tolist()
     idx = frandom.integer(NCELL, n).tolist()
     return idx
 
@@ -81,14 +123,14 @@ def addXT(times, idx, xt):
         nXt += nxt
         npe += nxt
         for j in range(nxt):
-            idx.append(idx[i] + random.choice(neighbour))
+            idx.append(idx[i] + neighbour[frandom.integer(7, 1).item()])
             times.append(times[i])
         i += 1
 
     return times, idx, nXt
 
 
-def addAP(times, h, ap):
+def addAP(times, h, ap, idx=None):
     """!@brief Generation of afterpulses."""
     """!
     Function that generates afterpulses(AP) events and adds them to the list of
@@ -102,6 +144,8 @@ def addAP(times, h, ap):
     @param h:       List containing the relative signal height of each
                     fired cell.
     @param ap:      Value (probability) of AP events.
+    @param idx:     Optional list containing the ID of each fired cell. If
+                    given the IDs of the AP events are appended to it.
     @return times:  List containing the time at which SiPM cells are fired,
                     including AP events.
     @return h:      List containing the relative signal height of each
@@ -122,6 +166,8 @@ def addAP(times, h, ap):
             mask = aptimes < SIGLEN
             times.extend(aptimes[mask])
             h.extend(heights[mask])
+            if idx is not None:
+                idx.extend([idx[i]] * np.count_nonzero(mask))
 
             # Count only ap inside time window
             npe += np.count_nonzero(mask)
@@ -131,7 +177,7 @@ def addAP(times, h, ap):
     return times, h, nAp
 
 
-def SiPMEventAction(times, idx, debug=False):
+def SiPMEventAction(times, idx, debug=False, state=None):
     """!@brief Calculates relative signal height for each photoelectron."""
     """!
     Since a SiPM cell may be hitted multiple times, recovery time has to be
@@ -143,9 +189,21 @@ def SiPMEventAction(times, idx, debug=False):
     The relative signal height, after a @f$\Delta_t@f$ time from the previous
     hit, is calculated supposing that each SiPM cell recovers as an RC circuit:
     @f[h(\Delta_t)=1-e^{-\frac{t}{\tau}}@f]
+    Hits are grouped by cell with a single sort, so the cost does not depend
+    on the number of cells fired more than once.
     @param times:   List containing the time of all events that have generated
                     an avalanche in the SiPM cells.
     @param idx:     List containing the corresponding cell IDs of the events.
+    @param state:   Optional state of the cells (@ref sensor.cellHistory). If
+                    given the first hit of a cell recovers from the last
+                    avalanche of the cell in the previous events. When
+                    events overlap (@ref variables.EVENTRATE faster than the
+                    signal length) that avalanche may come after the hit: the
+                    order of the two is not known, so the cell is taken as
+                    just fired and the hit has height 0. The state is updated
+                    with all the avalanches of the event by
+                    @ref sensor.fireCells.
+    @return times:  List containing the times sorted in time.
     @return h:      List containing the relative signal height of each
                     avalanche.
     """
@@ -157,34 +215,59 @@ def SiPMEventAction(times, idx, debug=False):
     h = np.ones_like(times)
 
     # If no repeated hits skip
-    if len(idx) != len(set(idx)):
-        idx = np.asarray(idx, dtype=np.int32)
+    if state is not None or len(idx) != len(set(idx)):
+        idx = np.asarray(idx, dtype=np.int64)
 
-        # Sorting times and theyr idx
-        idxsort = np.argsort(times)
+        # Sorting times and theyr idx (stable, already sorted lists are
+        # left unchanged)
+        idxsort = np.argsort(times, kind='stable')
         times = times[idxsort]
         idx = idx[idxsort]
 
-        _, uniqindex, uniqcts = np.unique(idx, return_index=True,
-                                          return_counts=True)
+        # Hits grouped by cell, in time order inside each cell
+        bycell = np.argsort(idx, kind='stable')
+        ctimes = times[bycell]
+        cidx = idx[bycell]
+        first = np.ones(times.size, dtype=bool)
+        first[1:] = cidx[1:] != cidx[:-1]
+
+        delays = np.diff(ctimes, prepend=0)
+        if state is None:
+            delays[first] = np.inf
+        else:
+            cidx = np.mod(cidx, state.lastfire.size)
+            # Overlapping events: the cell fired after this hit (see above)
+            delays[first] = np.maximum(ctimes[first] + state.clock - state.lastfire[cidx[first]], 0)
+        h[bycell] = 1 - exp(-delays / CELLRECOVERY)
 
-        # Idx of cells fired more than once
-        midx = uniqindex[uniqcts > 1]
+    return times.tolist(), h.tolist()
 
-        for m in midx:
-            mtimes = times[idx == idx[m]]
-            htemp = 1 - exp(-np.diff(mtimes, prepend=0) / CELLRECOVERY)
-            htemp[0] = 1
-            h[idx == idx[m]] = htemp
 
-    return times.tolist(), h.tolist()
+def sortPulses(times, *other):
+    """!@brief Sorts pulses in time."""
+    """!
+    Sorts the list of times and all the other lists describing the same
+    pulses (e.g. cell IDs and origin flags) keeping the relative order of
+    simultaneous pulses. @ref SiPMEventAction does not change the order of
+    sorted lists, so the other lists stay aligned to its output.
+    @param times:   List containing the time of each pulse.
+    @param other:   Other lists to be sorted as times.
+    @return lists:  Sorted lists.
+    """
+
+    idxsort = np.argsort(np.asarray(times, dtype=np.float32), kind='stable')
+    return [np.asarray(x)[idxsort].tolist() for x in (times, *other)]
 
 
-def SiPMSignalAction(times, sigH, snr=SNR, basespread=0):
+def SiPMSignalAction(times, sigH, snr=SNR, basespread=0, key=None, idx=None):
     """! @brief Generation of full SiPM signal."""
     """!
     Function that generates the full SiPM signal as the sum of the signals
     of each cell starting from gaussian noise.
+    If @ref variables.DISPATCH is set the fastest strategy measured on this
+    host is used for the number of cells fired in the event.
+    @sa noise.eventNoise for the generation of the noise.
+    @sa dispatch.synthesize for the choice of the strategy.
     @param times:       List containing the time at wich SiPM cells are fired,
                         including DCR, XT and AP events
     @param sigH:        List containing the correspondin relative pulse height
@@ -192,11 +275,23 @@ def SiPMSignalAction(times, sigH, snr=SNR, basespread=0):
     @param snr:         Signal to noise ratio converted into the RMS of the
                         gaussian noise.
     @param basespread:  Sigma of the value to add as baseline spread.
+    @param key:         Optional seed of the event. If given the gain
+                        variations and the noise are generated from it, so
+                        the signal can be generated again from the same
+                        pulse list.
+    @param idx:         Optional list containing the ID of the cell fired
+                        by each pulse. If given the gain of each pulse is
+                        taken from the cell maps (@ref sensor.cellGain)
+                        instead of being generated.
     @return signal:     Array containing the complete sigitized SiPM signal.
     """
 
+    rng = None
+    if key is not None:
+        rng = np.random.default_rng(key)
+
     # Start with gaussian noise
-    signal = frandom.normal(basespread, snr, SIGPTS)
+    signal = eventNoise(snr, basespread, rng)
 
     times = np.asarray(times, dtype=np.float32)
     # If any cell is hitted
@@ -205,12 +300,20 @@ def SiPMSignalAction(times, sigH, snr=SNR, basespread=0):
         # Convert times in units of samples
         times = np.uint32(times / SAMPLING)
         # Each signal has a ccgv
-        gainvars = frandom.normal(1, CCGV, times.size)
+        if idx is not None:
+            gainvars = cellGain(idx)
+        elif rng is None:
+            gainvars = frandom.normal(1, CCGV, times.size)
+        else:
+            gainvars = rng.normal(1, CCGV, times.size)
         sigH = sigH * gainvars
 
         # Generate cell signals and sum them
-        for i in range(times.size):
-            signal += PulseCPU(times[i], sigH[i])
+        if DISPATCH:
+            signal += synthesize(times, sigH)
+        else:
+            for i in range(times.size):
+                signal += PulseCPU(times[i], sigH[i])
 
     return signal
 
@@ -289,6 +392,78 @@ def signalAnalysis(signal, intstart, intgate, threshold, debug=False):
     return peak, integral, toa, tot, top
 
 
+def gateTable(gates):
+    """!@brief Indices used to analyse a list of gates, computed only once for each list."""
+    """!
+    @param gates:   List containing the (start, lenght, threshold) of each
+                    gate, start and lenght in units of samples.
+    @return table:  Tuple containing start, stop and threshold of each gate,
+                    the distinct windows (start, stop) and thresholds and the
+                    index of the window and of the threshold of each gate.
+    """
+
+    key = tuple(tuple(g) for g in gates)
+    if key not in gatetables:
+        start = np.array([g[0] for g in gates], dtype=np.int64)
+        stop = start + np.array([g[1] for g in gates], dtype=np.int64)
+        thr = np.array([g[2] for g in gates], dtype=np.float64)
+        windows, window = np.unique(np.stack((start, stop), axis=1), axis=0, return_inverse=True)
+        levels, level = np.unique(thr, return_inverse=True)
+        gatetables[key] = start, stop, thr, windows.tolist(), window.ravel(), levels, level.ravel()
+    return gatetables[key]
+
+
+def gateAnalysis(signal, gates, debug=False):
+    """!@brief Features extraction in many gates with a single pass over the signal."""
+    """!
+    Extracts the same features of @ref signalAnalysis in each gate. The
+    integral of the signal and the number of samples above each threshold
+    are accumulated once (prefix sums), then integrals, times over threshold
+    and times of arrival of all the gates are differences and searches on
+    them, whatever the length of the gates. Peaks are searched once for each
+    distinct window.
+    @param signal:      Array containing the digitized signal.
+    @param gates:       List containing the (start, lenght, threshold) of each
+                        gate, start and lenght in units of samples
+                        (@ref variables.GATES).
+    @return features:   Array of shape (len(gates), 5) containing peak,
+                        integral, time of arrival, time over threshold and
+                        time of peak in each gate. Features of the gates where
+                        the signal is below the threshold are set to -1.
+    """
+
+    features = np.full((len(gates), 5), -1, dtype=np.float32)
+    if not gates:
+        return features
+    start, stop, thr, windows, window, levels, level = gateTable(gates)
+    n = signal.size + 1
+
+    csum = np.zeros(n)
+    np.cumsum(signal, out=csum[1:])
+
+    # Peak of each distinct window
+    tops = np.array([signal[a:b].argmax() for a, b in windows])[window]
+    peaks = signal[start + tops]
+
+    # Samples above each distinct threshold
+    cabove = np.zeros((levels.size, n), dtype=np.int64)
+    np.cumsum(signal > levels[:, None], axis=1, out=cabove[:, 1:])
+    before = cabove[level, start]
+    tot = cabove[level, stop] - before
+    # First sample above threshold: where the count first exceeds the count
+    # at the start of the gate. Rows are shifted to search all of them at once.
+    cabove += np.arange(levels.size)[:, None] * n * n
+    toa = np.searchsorted(cabove.ravel(), before + level * n * n + 1) - level * n - 1 - start
+
+    sel = (peaks > thr) | bool(debug)
+    features[sel, 0] = peaks[sel]
+    features[sel, 1] = (csum[stop] - csum[start])[sel] * SAMPLING
+    features[sel, 2] = np.where(tot > 0, toa, 0)[sel] * SAMPLING
+    features[sel, 3] = tot[sel] * SAMPLING
+    features[sel, 4] = tops[sel] * SAMPLING
+    return features
+
+
 # Non simulation related functions
 def somestats(output, realpe=None):
     """!@brief Function that displays histograms of generated events."""
@@ -438,6 +613,19 @@ def sigPlot(signal, npe, ndcr, dev):
         txt.remove()
 
 
+def seedRandom(seed):
+    """! Function that seeds all the random generators used by the calling worker."""
+    """!
+    Seeds the Python and NumPy global generators and the generators of the
+    calling thread used by the kernels (@ref kernels.seedThread).
+    @param seed:    Non-negative integer seed smaller than 2**32.
+    """
+
+    random.seed(seed)
+    np.random.seed(seed)
+    seedThread(seed)
+
+
 def initializeRandomPool(seed=None):
     """! Function that initializes random seeds for each worker in the multiprocessing Pool."""
     """!
@@ -454,12 +642,11 @@ def initializeRandomPool(seed=None):
     if seed is None:
         seed = int.from_bytes(os.urandom(4), "big")
     seed += core - 1    # Change rng seed for each worker
-    random.seed(seed)
-    np.random.seed(seed)
+    seedRandom(seed)
     print(f"Initializing simulation on worker {core} with seed {seed}\r")
 
 
-def SaveFile(fname, out, other=None):
+def SaveFile(fname, out, other=None, shard=None, gates=None):
     f = uproot.recreate(fname, compression=uproot.LZ4(3))
 
     f['SiPMData'] = uproot.newtree({
@@ -493,9 +680,46 @@ def SaveFile(fname, out, other=None):
         f['GeometryData']['FiberY'].newbasket(np.float32(other[:, 4]))
         f['GeometryData']['FiberZ'].newbasket(np.float32(other[:, 5]))
 
+    if gates is not None:
+        # One group of branches for each gate, named after the gate number
+        gates = np.asarray(gates, dtype=np.float32)
+        f['GateData'] = uproot.newtree({f'{name:s}_{i:d}': np.float32
+                                        for i in range(gates.shape[1]) for name in GATEFEATURES})
+        for i in range(gates.shape[1]):
+            for j, name in enumerate(GATEFEATURES):
+                f['GateData'][f'{name:s}_{i:d}'].newbasket(gates[:, i, j])
+        f['GateSettings'] = uproot.newtree({'Start': np.float32, 'Gate': np.float32, 'Threshold': np.float32})
+        f['GateSettings']['Start'].newbasket(np.float32([g[0] * SAMPLING for g in GATES]))
+        f['GateSettings']['Gate'].newbasket(np.float32([g[1] * SAMPLING for g in GATES]))
+        f['GateSettings']['Threshold'].newbasket(np.float32([g[2] for g in GATES]))
+
+    if shard is not None:
+        # Describes the range of events of the shard (refer to merge.py)
+        f['ShardData'] = uproot.newtree({k: np.int64 for k in shard})
+        for k, v in shard.items():
+            f['ShardData'][k].newbasket(np.array([v], dtype=np.int64))
+
+
+def waveCompression(codec=WAVECODEC):
+    """!@brief hdf5 compression filter and level of a waveform codec."""
+    """!
+    @param codec:   Name of the codec: gzip-1 ... gzip-9, lzf or none.
+    @return compression: Name of the hdf5 filter or None.
+    @return level:  Compression level or None.
+    """
+
+    if codec == 'none':
+        return None, None
+    if codec == 'lzf':
+        return 'lzf', None
+    name, level = codec.split('-')
+    return name, int(level)
+
 
-def SaveWaves(fname, signals):
-    fname = datetime.now().strftime("%H_%M_%S_") + fname
+def SaveWaves(fname, signals, shard=None):
+    # Shards keep the given name so that they can be found by merge.py
+    if shard is None:
+        fname = datetime.now().strftime("%H_%M_%S_") + fname
 
     sipmsettings = [SIZE,
                     CELLSIZE,
@@ -508,13 +732,14 @@ def SaveWaves(fname, signals):
                     -20 * np.log10(SNR**2),
                     CCGV]
 
+    compression, level = waveCompression()
     with h5py.File(fname, 'a') as hf:
         dset1 = hf.create_dataset('Waveforms',
                                   shape=(signals.shape),
                                   dtype='f',
-                                  compression='gzip',
+                                  compression=compression,
                                   chunks=(1, signals.shape[1]),
-                                  compression_opts=9)
+                                  compression_opts=level)
         dset2 = hf.create_dataset('SiPMSettings',
                                   shape=(len(sipmsettings),),
                                   dtype='f',
@@ -523,3 +748,5 @@ def SaveWaves(fname, signals):
 
         dset1[...] = signals
         dset2[...] = sipmsettings
+        if shard is not None:
+            hf.attrs.update(shard)
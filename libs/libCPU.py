@@ -1,6 +1,6 @@
 """In this file I define all the functions I will use in the main file of simulation."""
 from variables import *
-from libs.FortranFunctions import fsignal
+fsignal = kernels.fsignal
 
 
 def PulseCPU(t, h):
@@ -1,7 +1,10 @@
 """In this file I define all the functions I will use in the main file of simulation."""
 from libs.libCPU import PulseCPU
-from libs.FortranFunctions import fsignal
+from libs.noise import eventNoise
+from libs.dispatch import synthesize
+from libs.sensor import cellGain
 from variables import *
+fsignal = kernels.fsignal
 
 # EDITING THIS FILE MAY SERIOUSLY COMPROMISE SIMULATION BEHAVIOUR
 
@@ -42,7 +45,7 @@ def PulseGPU(t, h):
 
 
 # Function that passes signals times and height to main function for generating signals
-def SiPMSignalAction(times, sigH, snr, basespread):
+def SiPMSignalAction(times, sigH, snr, basespread, key=None, idx=None):
     """! @brief Generation of full SiPM signal."""
     """!
     Function that generates the full SiPM signal as the sum of the signals
@@ -53,6 +56,8 @@ def SiPMSignalAction(times, sigH, snr, basespread):
     condition since usually VRAM is smaller than system memory.
     Those conditions are controlled by @ref variables.CPUTHRESHOLD and
     @ref variables.GPUMAX and are set by default at 100 and 2000.
+    If @ref variables.DISPATCH is set they are replaced by the crossover
+    points measured on this host.
 
     @param times:       List containing the time at wich SiPM cells are fired,
                         including DCR, XT and AP events
@@ -61,15 +66,30 @@ def SiPMSignalAction(times, sigH, snr, basespread):
     @param snr:         Signal to noise ratio converted into the RMS of the
                         gaussian noise.
     @param basespread:  Sigma of the value to add as baseline spread.
+    @param key:         Optional seed of the event used to generate gain
+                        variations and noise.
+    @param idx:         Optional list containing the ID of the cell fired
+                        by each pulse. If given the gain of each pulse is
+                        taken from the cell maps.
 
     @return signal:     Array containing the complete sigitized SiPM signal.
     """
     times = np.array(times, dtype=np.float32, copy=False)
     sigH = np.array(sigH, dtype=np.float32, copy=False)
     sigH = sigH[times < SIGLEN]
+    if idx is not None:
+        idx = np.asarray(idx)[times < SIGLEN]
     times = (times[times < SIGLEN] / SAMPLING).astype(np.uint32)
-    signal = normal(0, SNR, SIGPTS)
-    sigH = sigH * normal(1, CCGV, times.size)   # Each signal has a ccgv
+    rng = None if key is None else np.random.default_rng(key)
+    signal = eventNoise(snr, basespread, rng)
+    if idx is not None:
+        gainvars = cellGain(idx)
+    else:
+        gainvars = normal(1, CCGV, times.size) if rng is None else rng.normal(1, CCGV, times.size)
+    sigH = sigH * gainvars   # Each signal has a ccgv
+    if DISPATCH:
+        signal += synthesize(times, sigH)
+        return signal
     if (times.size < CPUTHRESHOLD) or (times.size > GPUMAX):
         for i in range(times.size):
             signal += PulseCPU(times[i], sigH[i])
@@ -0,0 +1,225 @@
+"""In this file I define the live monitor showing waveforms and statistics while the simulation runs.
+
+Workers never wait for the display: each worker writes at most MONITORFPS
+frames per second in a ring buffer in shared memory. The buffer holds the
+latest MONITORSIZE frames, older frames are overwritten (dropped) when the
+display falls behind. A separate process draws the frames at its own rate,
+or prints the statistics when there is no display (e.g. batch nodes).
+"""
+import atexit
+import collections
+import threading
+from multiprocessing.sharedctypes import RawArray, RawValue
+from types import SimpleNamespace
+from variables import *
+
+## Number of values stored with each frame: worker, 5 features and the
+## counters of the worker (events, photons, DCR, XT, AP, dropped frames).
+NINFO = 12
+
+##@cond
+monitorbuffer = None
+monitorprocess = None
+monitorowner = None
+workerstate = threading.local()
+##@endcond
+
+
+def monitorViews(shared):
+    """!@brief NumPy views of the ring buffer."""
+    """!
+    @param shared:  Namespace containing the shared arrays of the buffer.
+    @return buffer: Namespace containing the shared arrays and their views.
+    """
+
+    return SimpleNamespace(shared=shared,
+                           signals=np.frombuffer(shared.signals, dtype=np.float32).reshape(MONITORSIZE, SIGPTS),
+                           info=np.frombuffer(shared.info, dtype=np.float64).reshape(MONITORSIZE, NINFO),
+                           seq=np.frombuffer(shared.seq, dtype=np.int64))
+
+
+def startMonitor():
+    """!@brief Starts the display process of the monitor."""
+    """!
+    Must be called before starting the workers so that they share the
+    buffer. The monitor is started only once and stopped when the program
+    exits.
+    """
+
+    global monitorbuffer, monitorprocess, monitorowner
+    if monitorprocess is not None:
+        return
+    shared = SimpleNamespace(signals=RawArray('f', MONITORSIZE * SIGPTS),
+                             info=RawArray('d', MONITORSIZE * NINFO),
+                             seq=RawArray('q', MONITORSIZE),
+                             head=RawValue('q', 0),
+                             lock=multiprocessing.Lock(),
+                             stop=multiprocessing.Event())
+    monitorbuffer = monitorViews(shared)
+    monitorprocess = multiprocessing.Process(target=monitorDisplay, args=(shared,), daemon=True)
+    monitorprocess.start()
+    monitorowner = os.getpid()
+    atexit.register(stopMonitor)
+
+
+def stopMonitor():
+    """!@brief Stops the display process of the monitor."""
+
+    global monitorprocess
+    if monitorprocess is None or monitorowner != os.getpid():
+        return
+    monitorbuffer.shared.stop.set()
+    monitorprocess.join(5)
+    if monitorprocess.is_alive():
+        monitorprocess.terminate()
+    monitorprocess = None
+
+
+def monitorWrite():
+    """!@brief Writes the latest event of the calling worker in the buffer."""
+    """!
+    Only taking a position in the buffer is done under a lock, which is never
+    waited for: if it is taken by another worker the frame is dropped. The
+    sequence number of the slot is written last, so the display can tell
+    complete frames from the ones being written.
+    """
+
+    shared = monitorbuffer.shared
+    if not shared.lock.acquire(False):
+        workerstate.counts[5] += 1
+        return
+    shared.head.value += 1
+    ticket = shared.head.value
+    shared.lock.release()
+
+    slot = ticket % MONITORSIZE
+    monitorbuffer.seq[slot] = -1
+    monitorbuffer.signals[slot] = workerstate.signal
+    monitorbuffer.info[slot, 0] = workerstate.key
+    monitorbuffer.info[slot, 1:6] = workerstate.features
+    monitorbuffer.info[slot, 6:] = workerstate.counts
+    monitorbuffer.seq[slot] = ticket
+
+
+def monitorEvent(signal, features, debug):
+    """!@brief Sends an event to the monitor, called by the workers."""
+    """!
+    The counters of the worker are updated for every event, a frame with the
+    waveform, the features and the counters is written at most MONITORFPS
+    times per second. The call never blocks.
+    @param signal:      Array containing the waveform of the event.
+    @param features:    Tuple containing the features of the event.
+    @param debug:       Tuple containing the number of photons, DCR, XT and
+                        AP pulses of the event.
+    """
+
+    if monitorbuffer is None:
+        return
+    if not hasattr(workerstate, 'counts'):
+        workerstate.counts = np.zeros(NINFO - 6)
+        workerstate.key = os.getpid() * 2**22 + threading.get_native_id() % 2**22
+        workerstate.last = 0.
+    workerstate.counts[0] += 1
+    workerstate.counts[1:5] += debug
+    workerstate.signal = signal
+    workerstate.features = features
+
+    now = time.perf_counter()
+    if now - workerstate.last >= 1 / MONITORFPS:
+        workerstate.last = now
+        monitorWrite()
+
+
+def monitorFlush():
+    """!@brief Writes the counters of the calling worker at the end of a chunk."""
+    if monitorbuffer is not None and hasattr(workerstate, 'counts'):
+        monitorWrite()
+
+
+def monitorStats(counts, rate, dropped):
+    """!@brief Line of text with the statistics of all the workers."""
+    """!
+    @param counts:  Dictionary containing the latest counters of each worker.
+    @param rate:    Number of events simulated per second.
+    @param dropped: Number of frames overwritten before being displayed.
+    @return text:   String containing the statistics.
+    """
+
+    total = np.sum(list(counts.values()), axis=0) if counts else np.zeros(NINFO - 6)
+    n = max(total[0], 1)
+    return (f'{total[0]:.0f} events ({rate:.0f}/s) | per event: photons {total[1] / n:.2f}, '
+            f'DCR {total[2] / n:.2f}, XT {total[3] / n:.2f}, AP {total[4] / n:.2f} | '
+            f'dropped frames {total[5] + dropped:.0f}')
+
+
+def monitorDisplay(shared):
+    """!@brief Display process of the monitor."""
+    """!
+    Shows the latest waveform, the histogram of the integral of the sampled
+    events and the statistics of all the workers. Without a display the
+    statistics are printed once per second.
+    @param shared:  Namespace containing the shared arrays of the buffer.
+    """
+
+    buf = monitorViews(shared)
+    gui = sys.platform != 'linux' or bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    if gui:
+        try:
+            fig, (axw, axh) = plt.subplots(1, 2, figsize=(10, 4))
+            line, = axw.plot(np.arange(SIGPTS) * SAMPLING, np.zeros(SIGPTS), '-b', linewidth=0.5)
+            axw.set_xlabel('Time [ns]')
+            axw.grid(linestyle=':')
+            axh.set_xlabel('Integrated charge [A.U.]')
+            plt.show(block=False)
+        except Exception:
+            gui = False
+    period = 1 / MONITORFPS if gui else 1
+
+    counts = {}
+    integrals = collections.deque(maxlen=2000)
+    signal = None
+    dropped = 0
+    read = 0
+    lastevents = 0
+    last = time.perf_counter()
+    running = True
+    while running:
+        running = not shared.stop.is_set()
+
+        # Read the frames written since the last update
+        head = shared.head.value
+        for ticket in range(max(read + 1, head - MONITORSIZE + 1), head + 1):
+            slot = ticket % MONITORSIZE
+            if buf.seq[slot] != ticket:
+                continue
+            frame = buf.signals[slot].copy(), buf.info[slot].copy()
+            if buf.seq[slot] != ticket:
+                continue    # Overwritten or still being written
+            signal, info = frame
+            counts[info[0]] = info[6:]
+            integrals.append(info[2])
+        dropped += max(head - MONITORSIZE - read, 0)
+        read = head
+
+        now = time.perf_counter()
+        events = sum(c[0] for c in counts.values())
+        text = monitorStats(counts, (events - lastevents) / (now - last), dropped)
+        lastevents, last = events, now
+
+        if not gui:
+            print(text)
+            if running:
+                time.sleep(period)
+            continue
+        if not plt.fignum_exists(fig.number):
+            # Window closed by the user, workers keep writing in the buffer
+            return
+        if signal is not None:
+            line.set_ydata(signal)
+            axw.relim()
+            axw.autoscale_view(scalex=False)
+            axh.cla()
+            axh.hist(integrals, 100, color='k')
+            axh.set_xlabel('Integrated charge [A.U.]')
+        fig.suptitle(text, fontsize=9)
+        plt.pause(period)
@@ -0,0 +1,128 @@
+"""In this file I define the functions used to generate the electronic noise of SiPM signals."""
+from variables import *
+from libs.kernels import generator
+frandom = kernels.frandom
+
+##@cond
+noisebanks = [None] * NOISEBANKS
+##@endcond
+
+## Number of samples in each row of the noise banks.
+## Each row holds two slices of one signal, which never overlap.
+BANKPTS = 2 * SIGPTS
+
+
+def loadNoisePSD(fname):
+    """!@brief Reads a noise power spectral density from file."""
+    """!
+    The file must contain two columns: the frequency in MHz and the
+    corresponding power spectral density. Only the shape of the spectrum is
+    used, the noise amplitude is always set by @ref variables.SNR.
+    Lines starting with # are ignored.
+    @param fname:   Name of the file containing the PSD.
+    @return freq:   Array of frequencies in GHz (1 / ns).
+    @return psd:    Array containing the power spectral density.
+    """
+
+    data = np.loadtxt(fname, comments='#', ndmin=2)
+    freq = data[:, 0] * 1e-3
+    psd = data[:, 1]
+    idxsort = np.argsort(freq)
+    return freq[idxsort], psd[idxsort]
+
+
+def noiseShape(npts, fname):
+    """!@brief Amplitude filter used to colour white noise."""
+    """!
+    Computes the filter to be applied to the real FFT of a white noise
+    sequence of length npts. The filter is the square root of the PSD
+    interpolated at the FFT frequencies. The DC component is removed, the
+    baseline is set by @ref variables.BASESPREAD.
+    @param npts:    Number of samples of the noise sequence.
+    @param fname:   Name of the file containing the PSD.
+    @return shape:  Array containing the filter in the frequency domain.
+    """
+
+    freq, psd = loadNoisePSD(fname)
+    fftfreq = np.fft.rfftfreq(npts, SAMPLING)
+    shape = np.sqrt(np.clip(np.interp(fftfreq, freq, psd), 0, None))
+    shape[0] = 0
+    return shape
+
+
+def generateNoiseBank(n):
+    """!@brief Generation of a bank of noise samples."""
+    """!
+    Generates a bank of @ref variables.NOISEBANKSIZE rows of unit RMS noise.
+    Each row is @ref BANKPTS samples long. If @ref variables.NOISEPSD is
+    set each row is coloured with the measured PSD using a batched FFT over
+    all the rows. Filtering is circular so any slice of a row, wherever it
+    starts, has the correct spectrum.
+    Banks are generated with a seed derived from @ref variables.NOISESEED
+    and the bank number, hence they are the same on all workers. Banks are
+    stored as float32 to halve their memory.
+    @param n:       Number of the bank.
+    @return bank:   Array of shape (NOISEBANKSIZE, BANKPTS).
+    """
+
+    rng = np.random.default_rng([NOISESEED, n])
+    bank = rng.standard_normal((NOISEBANKSIZE, BANKPTS))
+
+    if NOISEPSD is not None:
+        shape = noiseShape(BANKPTS, NOISEPSD)
+        bank = np.fft.irfft(np.fft.rfft(bank, axis=1) * shape, n=BANKPTS, axis=1)
+        bank /= bank.std()
+
+    return bank.astype(np.float32)
+
+
+def noiseBank(n):
+    """!@brief Returns the n-th noise bank generating it on first use."""
+    """!
+    @param n:       Number of the bank.
+    @return bank:   Array containing the noise bank.
+    """
+
+    if noisebanks[n] is None:
+        noisebanks[n] = generateNoiseBank(n)
+    return noisebanks[n]
+
+
+def eventNoise(snr, basespread, rng=None):
+    """!@brief Generation of the noise of a single event."""
+    """!
+    If @ref variables.NOISEBANK is not set the noise is white gaussian noise
+    generated sample by sample. Otherwise a slice of a precomputed noise bank
+    is used. Reuse policy: slices start only at the beginning or in the
+    middle of a row, so two different slices never share samples and the
+    noise of two events is either independent or the same slice. The bank,
+    the row and the slice are drawn at random for each event, hence about
+    one event in 2 * NOISEBANKS * NOISEBANKSIZE shares the slice of another
+    one: banks should hold more slices than the events whose noise must be
+    independent. If @ref variables.NOISEFLIP is set the slice is also
+    randomly reversed in time and in sign, this does not change the noise
+    spectrum and reduces the correlation between events sharing a slice.
+    @param snr:         Signal to noise ratio converted into the RMS of the
+                        gaussian noise.
+    @param basespread:  Baseline value of the signal.
+    @param rng:         Optional numpy random Generator used to draw the
+                        noise. Banks do not depend on it, so the same
+                        generator state gives the same noise.
+    @return noise:      Array containing the noise of the event.
+    """
+
+    if not NOISEBANK:
+        if rng is None:
+            return frandom.normal(basespread, snr, SIGPTS)
+        return rng.normal(basespread, snr, SIGPTS)
+
+    if rng is None:
+        rng = generator()
+    b, row, half, flip = rng.integers((NOISEBANKS, NOISEBANKSIZE, 2, 4))
+    noise = noiseBank(b)[row, half * SIGPTS:(half + 1) * SIGPTS]
+    if NOISEFLIP:
+        if flip & 1:
+            noise = noise[::-1]
+        if flip & 2:
+            snr = -snr
+    return np.multiply(noise, snr, dtype=np.float64) + basespread
@@ -0,0 +1,111 @@
+"""In this file I define the functions used to store pulse lists and to generate waveforms again from them."""
+import variables
+from libs.lib import *
+from libs.cache import SENSORSETTINGS, configHash
+
+## Names of the settings needed to generate waveforms from pulse lists.
+REPLAYSETTINGS = SENSORSETTINGS + ('NOISEBANK', 'NOISEBANKSIZE', 'NOISEBANKS',
+                                   'NOISEFLIP', 'NOISESEED', 'NOISEPSD', 'CELLMAP', 'CELLSEED',
+                                   'FASTSIG', 'DISPATCH')
+
+
+def replayHash():
+    """!@brief Hash of the settings needed to generate waveforms from pulse lists."""
+    """!
+    Besides @ref REPLAYSETTINGS the device matters when each signal is
+    generated independently (-SIG).
+    @return hash:   String containing the hexadecimal hash.
+    """
+
+    return configHash(REPLAYSETTINGS, None if FASTSIG else args.device)
+
+
+def SaveReplay(fname, pulses):
+    """!@brief Saves the pulse lists of the events on a hdf5 file."""
+    """!
+    Each waveform is fully determined by its pulse list and by the seed used
+    to generate gain variations and noise, so storing them takes much less
+    space than storing the waveforms. Pulses of all the events are stored
+    in ragged columns: pulses of the i-th event are in the range
+    Offsets[i]:Offsets[i+1].
+    @param fname:   Name of the output file.
+    @param pulses:  List containing the pulses of each event as returned by
+                    @ref sipm.SiPM (times, heights, cell IDs, origin flags,
+                    seed).
+    """
+
+    offsets = np.zeros(len(pulses) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(p[0]) for p in pulses])
+    columns = {'Times': np.float32, 'Heights': np.float32,
+               'CellId': np.int32, 'Origin': np.int8}
+
+    with h5py.File(fname, 'w') as hf:
+        for i, (name, dtype) in enumerate(columns.items()):
+            data = np.concatenate([np.asarray(p[i], dtype=dtype) for p in pulses] + [np.empty(0, dtype)])
+            hf.create_dataset(name, data=data, compression='gzip', shuffle=True)
+        hf.create_dataset('Offsets', data=offsets, compression='gzip', shuffle=True)
+        hf.create_dataset('NoiseKey', data=np.array([p[4] for p in pulses], dtype=np.int64))
+        hf.attrs['ConfigHash'] = replayHash()
+        for name in REPLAYSETTINGS:
+            hf.attrs[name] = repr(getattr(variables, name))
+        hf.attrs['Device'] = repr(None if FASTSIG else args.device)
+
+
+def loadReplay(fname):
+    """!@brief Reads pulse lists from a hdf5 file."""
+    """!
+    Waveforms can only be generated again with the same settings used to
+    generate the pulse lists, a warning is issued if they differ.
+    @param fname:   Name of the file written by @ref SaveReplay.
+    @return replay: Dictionary containing the columns of the file.
+    """
+
+    with h5py.File(fname, 'r') as hf:
+        if hf.attrs['ConfigHash'] != replayHash():
+            warnings.warn(f'Settings differ from the ones used to generate {fname:s}, waveforms will not be the same',
+                          category=UserWarning)
+        return {k: hf[k][...] for k in hf.keys()}
+
+
+def replayPulses(replay, i):
+    """!@brief Pulse list of the i-th event."""
+    """!
+    @param replay:  Dictionary returned by @ref loadReplay.
+    @param i:       Number of the event.
+    @return pulses: Dictionary containing times, heights, cell IDs and origin
+                    flags of the pulses of the event.
+    """
+
+    start, stop = replay['Offsets'][i:i + 2]
+    return {k: replay[k][start:stop] for k in ('Times', 'Heights', 'CellId', 'Origin')}
+
+
+def replayEvent(replay, i):
+    """!@brief Generates again the waveform of the i-th event."""
+    """!
+    @param replay:  Dictionary returned by @ref loadReplay.
+    @param i:       Number of the event.
+    @return signal: Array containing the waveform of the event.
+    """
+
+    pulses = replayPulses(replay, i)
+    return SiPMSignalAction(pulses['Times'], pulses['Heights'], SNR, BASESPREAD, replay['NoiseKey'][i],
+                            pulses['CellId'] if CELLMAP else None)
+
+
+def replayEvents(replay, events=None):
+    """!@brief Generates again the waveforms of many events."""
+    """!
+    @param replay:  Dictionary returned by @ref loadReplay.
+    @param events:  Numbers of the events, if None all the events are
+                    generated.
+    @return signals: Array of shape (len(events), SIGPTS) containing the
+                    waveforms.
+    """
+
+    if events is None:
+        events = range(replay['NoiseKey'].size)
+    signals = np.empty((len(events), SIGPTS))
+    for j, i in enumerate(events):
+        signals[j] = replayEvent(replay, i)
+    return signals
@@ -0,0 +1,102 @@
+"""In this file I define the state of the sensor cells: fixed gain and dark count maps and the time of the last avalanche of each cell."""
+import threading
+from types import SimpleNamespace
+from variables import *
+from libs.hitmap import cachedAliasTable
+
+## Names of the settings that define the cell maps.
+CELLSETTINGS = ('CELLSEED', 'CCGV', 'HOTCELLS', 'HOTFACTOR')
+
+##@cond
+cellstate = threading.local()
+##@endcond
+
+
+def generateCells(seed=CELLSEED):
+    """!@brief Generation of the fixed maps of the sensor cells."""
+    """!
+    Each cell gets a gain drawn once from a gaussian distribution with sigma
+    @ref variables.CCGV, so repeated avalanches of the same cell (in the same
+    event or in different events) always have the same gain. A fraction
+    @ref variables.HOTCELLS of the cells is chosen as hot cells, with a dark
+    count probability @ref variables.HOTFACTOR times higher than the other
+    cells. The total dark count rate is still @ref variables.DCR.
+    Maps depend only on the seed and on the settings, so all the workers and
+    all the shards of a production see the same sensor.
+    @param seed:    Seed of the sensor.
+    @return cells:  Namespace containing the gain of each cell and the alias
+                    table of the dark counts (None if there are no hot cells).
+    """
+
+    n = CELLSIDE**2
+    rng = np.random.default_rng(seed)
+    gain = rng.normal(1, CCGV, n).astype(np.float32)
+    dark = None
+    nhot = int(round(HOTCELLS * n))
+    if nhot:
+        weights = np.ones(n)
+        weights[rng.choice(n, nhot, replace=False)] = HOTFACTOR
+        dark = cachedAliasTable(weights)
+    return SimpleNamespace(gain=gain, dark=dark)
+
+
+def cellGain(idx):
+    """!@brief Gain of the cells fired by the pulses."""
+    """!
+    Gains are gathered from the map, no random numbers are drawn. Crosstalk
+    may fire cells out of the range of IDs, which wrap around the sensor.
+    @param idx:     Array containing the ID of the cell fired by each pulse.
+    @return gain:   Array containing the gain of each pulse.
+    """
+
+    return np.take(cells.gain, idx, mode='wrap')
+
+
+def resetCells():
+    """!@brief Sets all the cells of the calling worker as fully recovered."""
+    """!
+    Called at the start of every chunk, so the history of the cells depends
+    only on the events of the chunk and not on the worker that simulates it.
+    """
+
+    if EVENTRATE is not None:
+        cellstate.lastfire = np.full(CELLSIDE**2, -np.inf)
+        cellstate.clock = 0.
+
+
+def cellHistory():
+    """!@brief State of the cells of the calling worker."""
+    """!
+    @return state:  Namespace containing the time of the last avalanche of
+                    each cell (ns) and the start time of the current event,
+                    None if events are independent (@ref variables.EVENTRATE
+                    not set).
+    """
+
+    if EVENTRATE is None:
+        return None
+    if not hasattr(cellstate, 'lastfire'):
+        resetCells()
+    return cellstate
+
+
+def fireCells(state, times, idx):
+    """!@brief Stores the avalanches of an event in the state of the cells."""
+    """!
+    All the pulses that fire a cell (photons, dark counts, crosstalk,
+    afterpulses and pulses of the background library) recharge it. The
+    clock is then moved to the start of the next event.
+    @param state:   State of the cells returned by @ref cellHistory.
+    @param times:   List containing the time of each pulse of the event.
+    @param idx:     List containing the ID of the cell fired by each pulse.
+    """
+
+    if len(idx):
+        cellid = np.mod(np.asarray(idx, dtype=np.int64), state.lastfire.size)
+        np.maximum.at(state.lastfire, cellid, np.asarray(times, dtype=np.float64) + state.clock)
+    state.clock += 1e9 / EVENTRATE
+
+
+## Fixed maps of the cells, generated in the main process before starting the
+## workers and only read by them (None if the cell maps are disabled).
+cells = generateCells(CELLSEED) if CELLMAP else None
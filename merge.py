@@ -0,0 +1,197 @@
+"""!File containing the tool used to merge the outputs of the shards of a production.
+
+Usage:
+    python merge.py -o merged.root shard_0.root shard_1.root ...
+    python merge.py -o merged.h5 shard_0.h5 shard_1.h5 ...
+
+Shards are written by @ref sipm.runShard with @ref lib.SaveFile and
+@ref lib.SaveWaves. Before merging the tool checks that all the shards belong
+to the same production and that together they cover all its events exactly
+once.
+"""
+import argparse
+import sys
+
+import h5py
+import numpy as np
+import uproot
+
+## Keys describing a shard, written by @ref sipm.runShard.
+SHARDKEYS = ('Shard', 'NShards', 'FirstEvent', 'NEvents', 'TotalEvents', 'Seed', 'ChunkSize')
+
+## Branches of the trees written by @ref lib.SaveFile.
+TREES = {'SiPMData': {'Integral': np.float32,
+                      'Peak': np.float32,
+                      'ToA': np.float32,
+                      'ToT': np.float32,
+                      'ToP': np.float32},
+         'GeometryData': {'EventId': np.int32,
+                          'FiberType': np.int8,
+                          'FiberId': np.int64,
+                          'FiberX': np.float32,
+                          'FiberY': np.float32,
+                          'FiberZ': np.float32}}
+
+## Branches describing the gates of @ref variables.GATES, written by
+## @ref lib.SaveFile together with a GateData tree containing the features of
+## each gate.
+GATEKEYS = ('Start', 'Gate', 'Threshold')
+
+
+def shardInfo(fname):
+    """!@brief Reads the description of a shard from its output file."""
+    """!
+    @param fname:   Name of the ROOT or hdf5 file written by a shard.
+    @return info:   Dictionary containing the keys in @ref SHARDKEYS.
+    """
+
+    if fname.endswith('.root'):
+        tree = uproot.open(fname)['ShardData']
+        return {k: int(v[0]) for k, v in tree.arrays(namedecode='utf-8').items()}
+    with h5py.File(fname, 'r') as hf:
+        if 'Shard' not in hf.attrs:
+            raise ValueError(f'{fname:s} was not written by a shard')
+        return {k: int(hf.attrs[k]) for k in SHARDKEYS}
+
+
+def checkCoverage(fnames):
+    """!@brief Checks that the shards cover all the events exactly once."""
+    """!
+    All the shards must have the same seed, number of shards, chunk size and
+    total number of events. Gaps and overlaps between the ranges of events
+    are reported before raising an error.
+    @param fnames:  List containing the names of the files of the shards.
+    @return fnames: Names of the files sorted by first event.
+    @return info:   Dictionary describing the merged production.
+    """
+
+    infos = {f: shardInfo(f) for f in fnames}
+    ref = next(iter(infos.values()))
+    for f, info in infos.items():
+        for k in ('NShards', 'TotalEvents', 'Seed', 'ChunkSize'):
+            if info[k] != ref[k]:
+                raise ValueError(f'{f:s} belongs to another production ({k:s} = {info[k]:d} instead of {ref[k]:d})')
+
+    fnames = sorted(infos, key=lambda f: infos[f]['FirstEvent'])
+    errors = []
+    nextevent = 0
+    for f in fnames:
+        first, n = infos[f]['FirstEvent'], infos[f]['NEvents']
+        if first > nextevent:
+            errors.append(f'events {nextevent:d}-{first - 1:d} are missing')
+        elif first < nextevent:
+            errors.append(f'events {first:d}-{nextevent - 1:d} of {f:s} are duplicated')
+        nextevent = max(nextevent, first + n)
+    if nextevent < ref['TotalEvents']:
+        errors.append(f'events {nextevent:d}-{ref["TotalEvents"] - 1:d} are missing')
+    shards = sorted(info['Shard'] for info in infos.values())
+    missing = sorted(set(range(ref['NShards'])) - set(shards))
+    if missing:
+        errors.append('missing shards ' + ', '.join(map(str, missing)))
+    if errors:
+        raise ValueError('Incomplete production: ' + '; '.join(errors))
+
+    info = dict(ref, Shard=0, NShards=1, FirstEvent=0, NEvents=ref['TotalEvents'])
+    return fnames, info
+
+
+def mergeWaves(fnames, out):
+    """!@brief Merges the waveforms of the shards on a single hdf5 file."""
+    """!
+    Compressed chunks are copied as they are from the shards to the output
+    file, so waveforms are never decompressed and compressed again. If the
+    layout of a shard differs from the first one its chunks are copied
+    decompressing them.
+    @param fnames:  List containing the names of the hdf5 files of the shards.
+    @param out:     Name of the output file.
+    """
+
+    fnames, info = checkCoverage(fnames)
+    with h5py.File(fnames[0], 'r') as hf:
+        ref = hf['Waveforms']
+        layout = (ref.dtype, ref.chunks, ref.compression, ref.compression_opts, ref.shuffle)
+        settings = hf['SiPMSettings'][...]
+        shape = (info['TotalEvents'],) + ref.shape[1:]
+
+    with h5py.File(out, 'w') as hout:
+        dout = hout.create_dataset('Waveforms', shape=shape, dtype=layout[0], chunks=layout[1],
+                                   compression=layout[2], compression_opts=layout[3], shuffle=layout[4])
+        hout.create_dataset('SiPMSettings', data=settings, compression='gzip', compression_opts=9)
+        hout.attrs.update(info)
+
+        for f in fnames:
+            with h5py.File(f, 'r') as hf:
+                din = hf['Waveforms']
+                first = hf.attrs['FirstEvent']
+                if din.shape[0] != hf.attrs['NEvents']:
+                    raise ValueError(f'{f:s} contains {din.shape[0]:d} waveforms instead of {hf.attrs["NEvents"]:d}')
+                if not np.array_equal(hf['SiPMSettings'][...], settings):
+                    raise ValueError(f'{f:s} was simulated with different SiPM settings')
+                same = (din.dtype, din.chunks, din.compression, din.compression_opts, din.shuffle) == layout
+                if same and first % din.chunks[0] == 0:
+                    for i in range(0, din.shape[0], din.chunks[0]):
+                        mask, chunk = din.id.read_direct_chunk((i,) + (0,) * (din.ndim - 1))
+                        dout.id.write_direct_chunk((first + i,) + (0,) * (din.ndim - 1), chunk, mask)
+                else:
+                    print(f'Layout of {f:s} differs, copying decompressed waveforms')
+                    dout[first:first + din.shape[0]] = din[...]
+            print(f'Merged {f:s}\r', end='')
+    print(f'\nMerged {len(fnames):d} shards ({info["TotalEvents"]:d} events) in {out:s}')
+
+
+def mergeFiles(fnames, out):
+    """!@brief Merges the trees of the shards on a single ROOT file."""
+    """!
+    Trees are concatenated following the order of the events. Feature trees
+    are small compared to waveforms, so their baskets are read and written
+    again.
+    @param fnames:  List containing the names of the ROOT files of the shards.
+    @param out:     Name of the output file.
+    """
+
+    fnames, info = checkCoverage(fnames)
+    files = [uproot.open(f) for f in fnames]
+
+    trees = dict(TREES)
+    if 'GateData' in files[0]:
+        # Branches depend on the number of gates
+        trees['GateData'] = {b.decode(): np.float32 for b in files[0]['GateData'].keys()}
+    f = uproot.recreate(out, compression=uproot.LZ4(3))
+    for name, branches in trees.items():
+        present = [name in fin for fin in files]
+        if not any(present):
+            continue
+        if not all(present):
+            raise ValueError(f'Tree {name:s} is missing from some shards')
+        arrays = [fin[name].arrays(list(branches), namedecode='utf-8') for fin in files]
+        f[name] = uproot.newtree(branches)
+        for b, dtype in branches.items():
+            f[name][b].newbasket(np.concatenate([a[b] for a in arrays]).astype(dtype))
+
+    if 'GateSettings' in files[0]:
+        gates = [fin['GateSettings'].arrays(GATEKEYS, namedecode='utf-8') for fin in files]
+        if any(not all(np.array_equal(g[k], gates[0][k]) for k in GATEKEYS) for g in gates):
+            raise ValueError('Shards were analysed with different gates')
+        f['GateSettings'] = uproot.newtree({k: np.float32 for k in GATEKEYS})
+        for k in GATEKEYS:
+            f['GateSettings'][k].newbasket(gates[0][k])
+
+    f['ShardData'] = uproot.newtree({k: np.int64 for k in info})
+    for k, v in info.items():
+        f['ShardData'][k].newbasket(np.array([v], dtype=np.int64))
+    print(f'Merged {len(fnames):d} shards ({info["TotalEvents"]:d} events) in {out:s}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('merge.py', description='Merges the outputs of the shards of a production')
+    parser.add_argument('files', nargs='+', help='Output files of the shards (.root or .h5)')
+    parser.add_argument('-o', '--output', required=True, help='Merged output file', metavar='filename')
+    args = parser.parse_args()
+
+    try:
+        if args.output.endswith('.root'):
+            mergeFiles(args.files, args.output)
+        else:
+            mergeWaves(args.files, args.output)
+    except ValueError as e:
+        sys.exit(str(e))
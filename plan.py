@@ -0,0 +1,282 @@
+"""!File containing the pre-flight planner estimating the resources needed by a simulation run.
+
+Usage:
+    python plan.py --events N [--input file | --npe mean] [--ram GB] [--disk GB]
+                   [--walltime hours] [--cores 1,8,32] [simulation options]
+
+Simulation options (e.g. -f files/HAM-S13615-1025.txt -W out.h5 -j 8) are the
+same of the run being planned. A short sample of events is simulated to
+measure the cost of each event, then peak memory, disk space and wall time of
+the full run are predicted for several numbers of cores. Chunk size, codec of
+the waveforms and number of shards fitting the given limits are recommended.
+The input sample is a text file with the photon times (ns) of an event on
+each line, if not given events with a Poisson number of photons are used.
+"""
+import argparse
+import resource
+import sys
+import tracemalloc
+
+planner = argparse.ArgumentParser('plan.py', description='Estimates the resources needed by a simulation run')
+planner.add_argument('--events', type=int, required=True, help='Number of events of the run')
+planner.add_argument('--input', type=str, help='Text file with the photon times of an event on each line')
+planner.add_argument('--npe', type=float, default=10, help='Mean number of photons if no input is given')
+planner.add_argument('--sample', type=int, default=500, help='Number of events simulated to measure costs')
+planner.add_argument('--ram', type=float, help='Memory available on the node in GB')
+planner.add_argument('--disk', type=float, help='Disk space available in GB')
+planner.add_argument('--walltime', type=float, help='Maximum wall time in hours')
+planner.add_argument('--cores', type=str, help='Comma separated numbers of cores to plan for')
+plan, sys.argv[1:] = planner.parse_known_args()
+
+from sipm import *
+
+## Codecs of the waveforms compared by the planner (refer to lib.waveCompression).
+CODECS = ('gzip-9', 'gzip-6', 'gzip-4', 'gzip-1', 'lzf', 'none')
+
+## Target duration of a chunk in seconds, long enough to hide the overhead of
+## a task and short enough to lose little work when a run is interrupted.
+CHUNKTIME = 30
+
+## Bytes in a GB.
+GB = 1024**3
+
+
+def loadSample(fname, nsample):
+    """!@brief Reads the photon times of the sample events."""
+    """!
+    @param fname:   Text file with the photon times of an event on each line,
+                    if None events with a Poisson number of photons are
+                    generated.
+    @param nsample: Maximum number of events.
+    @return times:  List containing the photon times of each event.
+    """
+
+    if fname is None:
+        rng = np.random.default_rng(0)
+        return [np.abs(rng.normal(20, 5, rng.poisson(plan.npe))).tolist() for i in range(nsample)]
+    times = []
+    with open(fname) as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                times.append([float(t) for t in line.split()])
+            if len(times) == nsample:
+                break
+    return times
+
+
+def eventCost(times, jobs):
+    """!@brief Measures time and memory needed by each event."""
+    """!
+    Events are first simulated on a single core to measure the time of an
+    event and the memory taken by its results, then on jobs cores to measure
+    the fraction of the run that does not scale with the number of cores
+    (Amdahl's law).
+    @param times:   List containing the photon times of the sample events.
+    @param jobs:    Number of workers of the parallel measurement.
+    @return cost:   Dictionary containing the time (s) and memory (bytes) of
+                    an event, the serial fraction, the memory of the main
+                    process (bytes) and the results of the sample.
+    """
+
+    seedRandom(0)
+    prepareTables()
+    SiPM(times[0])  # Tables built on first use are not part of the cost
+
+    start = time.perf_counter()
+    results = [SiPM(t) for t in times]
+    tevent = (time.perf_counter() - start) / len(times)
+
+    tracemalloc.start()
+    kept = [SiPM(t) for t in times[:200]]
+    memory = tracemalloc.get_traced_memory()[0] / len(kept)
+    tracemalloc.stop()
+    del kept
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    serial = 0.
+    if jobs > 1:
+        start = time.perf_counter()
+        if EXECUTOR == 'thread':
+            with ThreadPoolExecutor(jobs) as pool:
+                list(pool.map(SiPM, times))
+        else:
+            with Pool(jobs) as pool:
+                pool.map(SiPM, times)
+        speedup = tevent * len(times) / (time.perf_counter() - start)
+        serial = min(max((jobs / speedup - 1) / (jobs - 1), 0), 1)
+
+    return {'time': tevent, 'memory': memory, 'serial': serial, 'base': base, 'results': results}
+
+
+def outputCost(results):
+    """!@brief Measures size and writing time of the outputs of an event."""
+    """!
+    Waveforms of the sample are compressed in memory with each codec in
+    @ref CODECS. Features are stored uncompressed (5 float32 for each event
+    and for each gate in @ref variables.GATES),
+    pulse lists are written with @ref replay.SaveReplay if requested.
+    @param results: List containing the output of @ref sipm.SiPM for each
+                    event of the sample.
+    @return cost:   Dictionary containing size (bytes) and time (s) of an
+                    event for each output.
+    """
+
+    n = len(results)
+    cost = {'features': (20 * (1 + len(GATES or ())), 0.)}
+    if args.wavedump:
+        signals = np.array([r[2] for r in results], dtype=np.float32)
+        for codec in CODECS:
+            compression, level = waveCompression(codec)
+            start = time.perf_counter()
+            with h5py.File(f'plan-{codec:s}.h5', 'w', driver='core', backing_store=False) as hf:
+                dset = hf.create_dataset('Waveforms', data=signals, chunks=(1, SIGPTS),
+                                         compression=compression, compression_opts=level)
+                size = dset.id.get_storage_size()
+            cost[codec] = (size / n, (time.perf_counter() - start) / n)
+    if args.replay:
+        fname = os.path.join(CACHEDIR, f'plan-{os.getpid():d}.h5')
+        os.makedirs(CACHEDIR, exist_ok=True)
+        start = time.perf_counter()
+        SaveReplay(fname, [r[4] for r in results])
+        cost['replay'] = (os.path.getsize(fname) / n, (time.perf_counter() - start) / n)
+        os.remove(fname)
+    return cost
+
+
+def peakMemory(cost, nevents, jobs, chunk):
+    """!@brief Upper bound of the memory needed by a run."""
+    """!
+    The results of all the events are kept by the main process until the
+    end of the run, waveforms are converted to float32 before being written.
+    Each process worker is counted as a full copy of the main process (pages
+    shared after fork are not subtracted) and holds two copies of the results
+    of a chunk while sending them.
+    @param cost:    Dictionary returned by @ref eventCost.
+    @param nevents: Number of events.
+    @param jobs:    Number of workers.
+    @param chunk:   Number of events of each chunk.
+    @return memory: Peak memory in bytes.
+    """
+
+    memory = cost['base'] + nevents * cost['memory']
+    if args.wavedump:
+        memory += nevents * 4 * SIGPTS
+    if EXECUTOR == 'process':
+        memory += jobs * (cost['base'] + 2 * chunk * cost['memory'])
+    else:
+        memory += jobs * chunk * cost['memory']
+    return memory
+
+
+def wallTime(cost, nevents, cores, write):
+    """!@brief Wall time of a run in seconds."""
+    """!
+    @param cost:    Dictionary returned by @ref eventCost.
+    @param nevents: Number of events.
+    @param cores:   Number of cores.
+    @param write:   Time needed to write the outputs of an event (serial).
+    @return time:   Wall time in seconds.
+    """
+
+    s = cost['serial']
+    return nevents * (cost['time'] * (s + (1 - s) / cores) + write)
+
+
+def chunkSize(cost, nevents, jobs):
+    """!@brief Recommended number of events of each chunk."""
+    """!
+    Chunks last about @ref CHUNKTIME seconds, but each worker gets at least
+    four chunks to balance the load. If a memory limit is given the chunks
+    being simulated take at most 10% of it.
+    """
+
+    chunk = int(CHUNKTIME / cost['time'])
+    if plan.ram is not None:
+        chunk = min(chunk, int(0.1 * plan.ram * GB / (2 * jobs * cost['memory'])))
+    return int(max(10, min(chunk, -(-nevents // (4 * jobs)))))
+
+
+def chooseCodec(outputs, nevents):
+    """!@brief Recommended codec of the waveforms."""
+    """!
+    The fastest codec fitting the disk limit is chosen. Without a limit the
+    fastest codec at most 10% larger than the smallest one is chosen.
+    @param outputs: Dictionary returned by @ref outputCost.
+    @param nevents: Number of events.
+    @return codec:  Name of the codec or None if none fits the disk limit.
+    """
+
+    other = sum(outputs[k][0] for k in ('features', 'replay') if k in outputs)
+    codecs = sorted(CODECS, key=lambda c: outputs[c][1])
+    if plan.disk is None:
+        smallest = min(outputs[c][0] for c in CODECS)
+        return next(c for c in codecs if outputs[c][0] <= 1.1 * smallest)
+    for c in codecs:
+        if nevents * (outputs[c][0] + other) <= plan.disk * GB:
+            return c
+    return None
+
+
+def printPlan():
+    """!@brief Measures the costs and prints the plan of the run."""
+
+    nevents = plan.events
+    times = loadSample(plan.input, plan.sample)
+    print(f'\nMeasuring costs on {len(times):d} events...')
+    cost = eventCost(times, min(nJobs, multiprocessing.cpu_count()))
+    outputs = outputCost(cost['results'])
+
+    codec = chooseCodec(outputs, nevents) if args.wavedump else None
+    written = dict(outputs)
+    if args.wavedump:
+        written['waveforms'] = outputs[codec or min(CODECS, key=lambda c: outputs[c][0])]
+    for c in CODECS:
+        written.pop(c, None)
+    disk = nevents * sum(v[0] for v in written.values())
+    write = sum(v[1] for v in written.values())
+
+    print(f'\nTime per event:       {cost["time"] * 1e3:.3f} ms (serial fraction {cost["serial"]:.2f})')
+    print(f'Memory per event:     {cost["memory"] / 1024:.1f} kB (results kept until the end of the run)')
+    if args.wavedump:
+        print('\nWaveform codec     size / event   time / event   total size')
+        for c in CODECS:
+            size, t = outputs[c]
+            print(f'{c:16s} {size / 1024:10.2f} kB {t * 1e3:11.3f} ms {nevents * size / GB:10.2f} GB')
+    print(f'\nDisk space:           {disk / GB:.2f} GB ({", ".join(written):s})')
+
+    cores = sorted({1, nJobs} | {2**i for i in range(1, 12) if 2**i < nJobs})
+    if plan.cores:
+        cores = sorted({int(c) for c in plan.cores.split(',')})
+    print(f'\nCores   chunk size    wall time      peak memory ({EXECUTOR:s} workers)')
+    for n in cores:
+        chunk = chunkSize(cost, nevents, n)
+        print(f'{n:5d} {chunk:12d} {wallTime(cost, nevents, n, write) / 3600:10.2f} h '
+              f'{peakMemory(cost, nevents, n, chunk) / GB:12.2f} GB')
+
+    print('\nRecommendations:')
+    print(f'CHUNKSIZE = {chunkSize(cost, nevents, nJobs):d}')
+    if args.wavedump:
+        if codec is None:
+            print(f'No codec fits {plan.disk:.0f} GB of disk, split the run in shards or store pulse lists (-R) instead of waveforms')
+        else:
+            print(f"WAVECODEC = '{codec:s}'")
+    if plan.ram is not None:
+        chunk = chunkSize(cost, nevents, nJobs)
+        fixed = peakMemory(cost, 0, nJobs, chunk)
+        perevent = peakMemory(cost, 1, nJobs, chunk) - fixed
+        if fixed > plan.ram * GB:
+            print(f'{nJobs:d} {EXECUTOR:s} workers do not fit in {plan.ram:.0f} GB, reduce -j or use threads (-x thread)')
+        elif peakMemory(cost, nevents, nJobs, chunk) > plan.ram * GB:
+            pershard = max(int((plan.ram * GB - fixed) / perevent), 1)
+            print(f'Run does not fit in {plan.ram:.0f} GB: split it in {-(-nevents // pershard):d} shards '
+                  f'of at most {pershard:d} events (-S I N)')
+    if plan.walltime is not None:
+        fit = [n for n in cores if wallTime(cost, nevents, n, write) <= plan.walltime * 3600]
+        if fit:
+            print(f'At least {fit[0]:d} cores are needed to finish in {plan.walltime:.1f} h')
+        else:
+            print(f'Run does not finish in {plan.walltime:.1f} h with up to {cores[-1]:d} cores, split it in shards')
+
+
+if __name__ == '__main__':
+    printPlan()
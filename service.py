@@ -0,0 +1,283 @@
+"""!File containing a local simulation service that digitizes photon times sent over a Unix socket.
+
+The service keeps settings, tables and workers loaded, so jobs producing
+photons (e.g. Geant4) can stream them and get the features back while they
+run. It is started with:
+    python service.py [simulation options] [--socket path]
+
+Every message starts with a fixed header followed by its payload, all
+numbers are little endian.
+    Request:    header (magic 'SIPM', request id uint64, nevents uint32,
+                nphotons uint32), number of photons of each event
+                (nevents x uint32), photon times in ns (nphotons x float64).
+    Response:   header (magic 'SIPM', request id uint64, status uint32,
+                payload size in bytes uint32), features of each event
+                (nevents x 5 float64, same order as @ref sipm.SiPM) if the
+                status is 0, otherwise an error message (utf-8).
+
+Responses to the requests of a connection are sent in the same order of
+the requests. Small requests of all the clients are batched together, large
+requests are split in batches of @ref variables.SERVICEBATCH events. When
+the workers are busy the service stops reading from the clients
+(backpressure). @ref requestFeatures is a client that can be used to test
+the service or as a reference for other clients.
+"""
+import asyncio
+import socket
+import stat
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from sipm import *
+
+## Magic bytes at the start of each message.
+MAGIC = b'SIPM'
+
+## Header of requests: magic, request id, number of events, number of photons.
+REQUEST = struct.Struct('<4sQII')
+
+## Header of responses: magic, request id, status, payload size in bytes.
+RESPONSE = struct.Struct('<4sQII')
+
+
+def serviceFeatures(times, seed):
+    """!@brief Features of a batch of events, run by the workers."""
+    """!
+    @param times:   List containing the photon times of each event.
+    @param seed:    Seed of the batch.
+    @return features: Array of shape (len(times), 5).
+    """
+
+    results = simulateChunk(times, [None] * len(times), seed)
+    return np.array([r[0] for r in results], dtype=np.float64).reshape(-1, 5)
+
+
+def deliver(items, slots, task):
+    """!@brief Splits the features of a batch between its requests."""
+    slots.release()
+    if task.exception() is not None:
+        for events, future in items:
+            if not future.done():
+                future.set_exception(task.exception())
+        return
+    start = 0
+    for events, future in items:
+        if not future.done():
+            future.set_result(task.result()[start:start + len(events)])
+        start += len(events)
+
+
+async def batcher(queue, pool, slots, seed):
+    """!@brief Collects requests in batches and runs them on the workers."""
+    """!
+    Requests are collected until the batch contains at least
+    @ref variables.SERVICEBATCH events or @ref variables.SERVICEWAIT ms have
+    passed since the first one. A batch is started only when a worker is
+    free, otherwise requests wait in the queue.
+    @param queue:   Queue containing (events, future) pairs.
+    @param pool:    Executor running the batches.
+    @param slots:   Semaphore counting the free workers.
+    @param seed:    Global seed of the service.
+    """
+
+    loop = asyncio.get_running_loop()
+    nbatch = 0
+    while True:
+        items = [await queue.get()]
+        nevents = len(items[0][0])
+        deadline = loop.time() + SERVICEWAIT / 1000
+        while nevents < SERVICEBATCH:
+            try:
+                item = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            items.append(item)
+            nevents += len(item[0])
+
+        await slots.acquire()
+        times = [t for events, future in items for t in events]
+        task = loop.run_in_executor(pool, serviceFeatures, times, chunkSeed(seed, nbatch))
+        task.add_done_callback(partial(deliver, items, slots))
+        nbatch += 1
+
+
+async def submit(queue, counts, times):
+    """!@brief Splits a request in batches and waits for their features."""
+    """!
+    @param queue:   Queue of the batcher.
+    @param counts:  Array containing the number of photons of each event.
+    @param times:   Array containing the photon times of all the events.
+    @return features: Array of shape (counts.size, 5).
+    """
+
+    if counts.sum() != times.size:
+        raise ValueError(f'Request contains {times.size:d} photons instead of {counts.sum():d}')
+    events = [t.tolist() for t in np.split(times, np.cumsum(counts)[:-1])] if counts.size else []
+
+    loop = asyncio.get_running_loop()
+    futures = []
+    for i in range(0, len(events), SERVICEBATCH):
+        futures.append(loop.create_future())
+        await queue.put((events[i:i + SERVICEBATCH], futures[-1]))
+    if not futures:
+        return np.empty((0, 5))
+    return np.concatenate(await asyncio.gather(*futures))
+
+
+async def sendResponses(writer, pending):
+    """!@brief Sends the responses of a client in the order of its requests."""
+    """!
+    @param writer:  Stream of the client.
+    @param pending: Queue containing (request id, future) pairs, terminated by
+                    None.
+    """
+
+    closed = False
+    while True:
+        item = await pending.get()
+        if item is None:
+            break
+        rid, future = item
+        if closed:
+            future.cancel()
+            continue
+        try:
+            status, payload = 0, np.ascontiguousarray(await future, dtype='<f8').tobytes()
+        except Exception as e:
+            status, payload = 1, str(e).encode()
+        try:
+            writer.write(RESPONSE.pack(MAGIC, rid, status, len(payload)) + payload)
+            await writer.drain()
+        except ConnectionError:
+            # The client is gone, remaining requests are dropped
+            closed = True
+
+
+async def handleClient(reader, writer, queue):
+    """!@brief Reads the requests of a client."""
+    """!
+    At most @ref variables.SERVICEPENDING requests of a client are processed
+    at once, then the client is not read until a response is sent.
+    @param reader:  Stream of the client.
+    @param writer:  Stream of the client.
+    @param queue:   Queue of the batcher.
+    """
+
+    pending = asyncio.Queue(SERVICEPENDING)
+    sender = asyncio.create_task(sendResponses(writer, pending))
+    try:
+        while True:
+            try:
+                magic, rid, nevents, nphotons = REQUEST.unpack(await reader.readexactly(REQUEST.size))
+                if magic != MAGIC:
+                    print('Invalid request, closing connection')
+                    break
+                counts = np.frombuffer(await reader.readexactly(4 * nevents), dtype='<u4')
+                times = np.frombuffer(await reader.readexactly(8 * nphotons), dtype='<f8')
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            await pending.put((rid, asyncio.ensure_future(submit(queue, counts, times))))
+    finally:
+        await pending.put(None)
+        await sender
+        writer.close()
+
+
+async def serve(path=SOCKET, jobs=nJobs, executor=EXECUTOR, seed=SEED):
+    """!@brief Runs the simulation service until it is interrupted."""
+    """!
+    @param path:    Path of the Unix socket.
+    @param jobs:    Number of workers.
+    @param executor: Type of workers: "process" or "thread".
+    @param seed:    Global seed of the service, each batch is seeded with
+                    @ref sipm.chunkSeed. If None it is taken from the
+                    operating system entropy pool.
+    """
+
+    if seed is None:
+        seed = int.from_bytes(os.urandom(4), "big")
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise FileExistsError(f'{path:s} exists and is not a socket')
+        os.remove(path)     # Left by a previous service
+
+    prepareTables()
+    if MONITOR:
+        startMonitor()
+    pool = ThreadPoolExecutor(jobs) if executor == 'thread' else ProcessPoolExecutor(jobs)
+    queue = asyncio.Queue(2 * jobs)
+    slots = asyncio.Semaphore(jobs)
+    batching = asyncio.create_task(batcher(queue, pool, slots, seed))
+
+    server = await asyncio.start_unix_server(partial(handleClient, queue=queue), path)
+    print(f'Simulation service listening on {path:s} ({jobs:d} {executor:s} workers)')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        batching.cancel()
+        pool.shutdown(cancel_futures=True)
+
+
+def packRequest(rid, times):
+    """!@brief Encodes a request."""
+    """!
+    @param rid:     Request id.
+    @param times:   List containing the photon times of each event.
+    @return message: Bytes of the request.
+    """
+
+    counts = np.array([len(t) for t in times], dtype='<u4')
+    flat = np.concatenate([np.asarray(t, dtype='<f8') for t in times] + [np.empty(0, dtype='<f8')])
+    return REQUEST.pack(MAGIC, rid, counts.size, flat.size) + counts.tobytes() + flat.tobytes()
+
+
+def recvExactly(sock, n):
+    """!@brief Receives exactly n bytes from a socket."""
+    data = bytearray(n)
+    view = memoryview(data)
+    while view:
+        nbytes = sock.recv_into(view)
+        if not nbytes:
+            raise ConnectionError('Service closed the connection')
+        view = view[nbytes:]
+    return bytes(data)
+
+
+def requestFeatures(times, path=SOCKET, batch=SERVICEBATCH, pipeline=SERVICEPENDING):
+    """!@brief Client of the simulation service."""
+    """!
+    Events are sent in requests of batch events keeping at most pipeline
+    requests waiting for a response.
+    @param times:   List containing the photon times of each event.
+    @param path:    Path of the Unix socket of the service.
+    @param batch:   Number of events of each request.
+    @param pipeline: Maximum number of requests waiting for a response.
+    @return features: Array of shape (len(times), 5).
+    """
+
+    requests = [times[i:i + batch] for i in range(0, len(times), batch)]
+    features = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sent = 0
+        for rid in range(len(requests)):
+            while sent < len(requests) and sent - rid < pipeline:
+                sock.sendall(packRequest(sent, requests[sent]))
+                sent += 1
+            magic, rrid, status, size = RESPONSE.unpack(recvExactly(sock, RESPONSE.size))
+            payload = recvExactly(sock, size)
+            if magic != MAGIC or rrid != rid:
+                raise ConnectionError('Invalid response from the service')
+            if status:
+                raise RuntimeError(f'Service error: {payload.decode():s}')
+            features.append(np.frombuffer(payload, dtype='<f8').reshape(-1, 5))
+    return np.concatenate(features) if features else np.empty((0, 5))
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print('\nSimulation service stopped')
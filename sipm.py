@@ -3,7 +3,16 @@
 Author: Edoardo Proserpio
 Email: eproserpio@studenti.uninsubria.it edoardo.proserpio@gmail.com
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from libs.lib import *
+from libs.noise import noiseBank
+from libs.dispatch import chooseStrategy
+from libs.background import darkBackground, backgroundLibrary
+from libs.replay import *
+from libs.emulator import emulatorTable, emulateFeatures
+from libs.checkpoint import openCheckpoint, checkpointSeed, chunkResults, saveChunk
+from libs.monitor import startMonitor, monitorEvent, monitorFlush
+from libs.sensor import cellHistory, fireCells, resetCells
 
 
 def SiPM(times, other=None):
@@ -32,42 +41,94 @@ def SiPM(times, other=None):
 
     @return signal If the options -W is enabled the complete SiPM signal
     will be passed in the output. Otherwise this output is "None".
+
+    @return pulses If the option -R is enabled the list of pulses of the
+    event (times, heights, cell IDs, origin flags) and the seed used to
+    generate gain variations and noise. Otherwise this output is "None".
+    @sa replay.SaveReplay
+
+    @return gates If @ref variables.GATES is set the features of the signal
+    in each gate (@ref lib.gateAnalysis). Otherwise this output is "None".
     """
     times = list(filter(isinwindow, times))
     npe = len(times)
     ndcr = 0
     nxt = 0
     nap = 0
+    bkg = None
+    record = args.replay is not None
+    cellstate = cellHistory()
+    # Cell IDs are kept aligned to the pulses to apply the cell maps or to
+    # store the avalanches in the state of the cells
+    track = record or CELLMAP or cellstate is not None
 
     # Generate DCR events (times)
     if not args.nodcr:
-        dcrTime, ndcr = addDCR(DCR)
-        if ndcr:
-            times.extend(dcrTime)
+        if BKGLIBRARY:
+            # Dark pulses are taken from the background library
+            bkg = darkBackground()
+        else:
+            dcrTime, ndcr = addDCR(DCR)
+            if ndcr:
+                times.extend(dcrTime)
 
     # Calculate idx of hitted cells
-    idx = HitCells(len(times))
+    idx = HitCells(npe)
+    idx.extend(DarkCells(ndcr))
 
     # Add XT events
     if not args.noxt:
         times, idx, nxt = addXT(times, idx, XT)
 
+    # Keep track of the origin of each pulse
+    if record:
+        origin = [PHOTON] * npe + [DARK] * ndcr + [CROSSTALK] * nxt
+        times, idx, origin = sortPulses(times, idx, origin)
+    elif track:
+        times, idx = sortPulses(times, idx)
+
     # Calculate signal height of each cell
-    times, sigH = SiPMEventAction(times, idx, args.debug)
+    times, sigH = SiPMEventAction(times, idx, args.debug, cellstate)
 
     # Add AP events
     if not args.noap:
-        times, sigH, nap = addAP(times, sigH, AP)
+        times, sigH, nap = addAP(times, sigH, AP, idx if track else None)
+        if record:
+            origin.extend([AFTERPULSE] * nap)
+
+    # Mix pre-simulated dark pulses
+    if bkg is not None:
+        bkgtimes, bkgh, bkgcells, bkgorigin, bkgcounts = bkg
+        times.extend(bkgtimes.tolist())
+        sigH.extend(bkgh.tolist())
+        if track:
+            idx.extend(bkgcells.tolist())
+        if record:
+            origin.extend(bkgorigin.tolist())
+        ndcr += int(bkgcounts[0])
+        nxt += int(bkgcounts[1])
+        nap += int(bkgcounts[2])
+
+    if cellstate is not None:
+        fireCells(cellstate, times, idx)
 
     # Generate digital signals
-    signal = SiPMSignalAction(times, sigH, SNR, BASESPREAD)
+    key = None
+    if record:
+        key = generator().integers(2**63)
+    signal = SiPMSignalAction(times, sigH, SNR, BASESPREAD, key, idx if CELLMAP else None)
 
     # # Select signal in the integration gate
     peak, integral, tstart, tovert, tpeak = signalAnalysis(signal, INTSTART, INTGATE, THRESHOLD, args.debug)
+    gates = None
+    if GATES:
+        gates = gateAnalysis(signal, GATES, args.debug)
 
     # Plots
     if args.Graphics:
-        if not args.signal:
+        if DISPATCH:
+            dev = chooseStrategy(len(times))
+        elif not args.signal:
             dev = 'cpu-fast'
         elif args.device == 'cpu':
             dev = 'cpu'
@@ -78,5 +139,212 @@ def SiPM(times, other=None):
                 dev = 'gpu'
         sigPlot(signal, len(times), ndcr, dev)
     debug = (npe, ndcr, nxt, nap)
+    if MONITOR:
+        monitorEvent(signal, (peak, integral, tstart, tovert, tpeak), debug)
+
+    pulses = None
+    if record:
+        pulses = (times, sigH, idx, origin, key)
+
+    return (peak, integral, tstart, tovert, tpeak), other, signal, debug, pulses, gates
+
+
+def prepareTables():
+    """! @brief Builds the shared tables before starting the workers."""
+    """! Noise banks and the background library are built (or loaded) once in
+    the main process. Threads share the same copy, forked processes share it
+    until they write on it, which never happens since tables are read-only.
+    """
+    if NOISEBANK:
+        for b in range(NOISEBANKS):
+            noiseBank(b)
+    if BKGLIBRARY and not args.nodcr:
+        backgroundLibrary()
+
+
+def chunkSeed(seed, chunk):
+    """! @brief Seed of a chunk of events."""
+    """! The seed depends only on the global seed and on the position of the
+    chunk, not on the worker that simulates it.
+
+    @param seed Global seed of the simulation.
+
+    @param chunk Index of the chunk.
+
+    @return seed Seed of the chunk.
+    """
+    return int(np.random.SeedSequence([seed, chunk]).generate_state(1)[0])
+
+
+def simulateChunk(times, other, seed):
+    """! @brief Simulates a chunk of events on the calling worker."""
+    """! All the random generators of the worker are seeded with the seed of the
+    chunk and all the cells are recovered before simulating the events.
+
+    @param times List containing the photon times of each event.
+
+    @param other List containing the other informations of each event.
+
+    @param seed Seed of the chunk.
+
+    @return results List containing the output of @ref SiPM for each event.
+    """
+    seedRandom(seed)
+    resetCells()
+    results = [SiPM(t, o) for t, o in zip(times, other)]
+    if MONITOR:
+        monitorFlush()
+    return results
+
+
+def simulateTask(task):
+    """! @brief Simulates a task (times, other, seed, chunk index) returning its index."""
+    return task[3], simulateChunk(*task[:3])
+
+
+def runSimulation(times, other=None, seed=SEED, jobs=nJobs, executor=EXECUTOR, first=0,
+                  checkpoint=CHECKPOINT, resume=bool(args.resume)):
+    """! @brief Simulates a list of events in parallel."""
+    """! Events are split in chunks of @ref variables.CHUNKSIZE events, each
+    chunk is simulated by a worker with its own seed (@ref chunkSeed).
+    Workers can be processes (multiprocessing Pool) or threads. Threads share
+    the settings and all the tables, and run in parallel in the kernels that
+    release the GIL (Fortran pulse kernels, large NumPy operations). Each
+    thread has its own random streams (@ref kernels.generator).
+
+    @param times List containing the photon times of each event.
+
+    @param other Optional list containing the other informations of each
+    event.
+
+    @param seed Global seed of the simulation. If None it is taken from the
+    operating system entropy pool.
+
+    @param jobs Number of workers.
 
-    return (peak, integral, tstart, tovert, tpeak), other, signal, debug
+    @param executor Type of workers: "process" or "thread".
+
+    @param first Index of the first event in the whole production. Chunks
+    are numbered from the start of the production, so a range of events
+    starting on a chunk boundary gives the same results when simulated alone.
+
+    @param checkpoint Optional directory where each chunk is stored as soon
+    as it is completed (@ref checkpoint.saveChunk). Waveforms are returned
+    only if they are written (-W), as float32.
+
+    @param resume If True the chunks already stored in the checkpoint
+    directory are not simulated again. The output is the same of an
+    uninterrupted simulation.
+
+    @return results List containing the output of @ref SiPM for each event.
+    """
+    nevents = len(times)
+    if other is None:
+        other = [None] * nevents
+    chunks = {}
+    if checkpoint is not None:
+        seed, chunks = openCheckpoint(checkpoint, times, seed, first, resume)
+    elif seed is None:
+        seed = int.from_bytes(os.urandom(4), "big")
+
+    tasks = []
+    for i in range(0, nevents, CHUNKSIZE):
+        c = (first + i) // CHUNKSIZE
+        if c not in chunks:
+            tasks.append((times[i:i + CHUNKSIZE], other[i:i + CHUNKSIZE], chunkSeed(seed, c), c))
+
+    def collect(completed):
+        # Chunks are stored as soon as they are completed
+        for c, results in completed:
+            if checkpoint is not None:
+                # Same results whether the chunk is simulated or resumed
+                results = chunkResults(results)
+                saveChunk(checkpoint, c, results)
+            chunks[c] = results
+
+    if tasks:
+        prepareTables()
+        if MONITOR:
+            startMonitor()
+        if executor == 'thread':
+            with ThreadPoolExecutor(jobs) as pool:
+                collect(f.result() for f in as_completed([pool.submit(simulateTask, t) for t in tasks]))
+        else:
+            with Pool(jobs) as pool:
+                collect(pool.imap_unordered(simulateTask, tasks))
+
+    return [r for c in sorted(chunks) for r in chunks[c]]
+
+
+def shardRange(nevents, shard, nshards):
+    """! @brief Range of events simulated by a shard."""
+    """! Events are split in shards made of whole chunks of
+    @ref variables.CHUNKSIZE events, so each chunk has the same seed whatever
+    the number of shards.
+
+    @param nevents Total number of events of the production.
+
+    @param shard Index of the shard (starting from 0).
+
+    @param nshards Number of shards.
+
+    @return first Index of the first event of the shard.
+
+    @return last Index of the last event of the shard plus one.
+    """
+    nchunks = -(-nevents // CHUNKSIZE)
+    first = min(nchunks * shard // nshards * CHUNKSIZE, nevents)
+    last = min(nchunks * (shard + 1) // nshards * CHUNKSIZE, nevents)
+    return first, last
+
+
+def runShard(times, other=None, shard=SHARD[0], nshards=SHARD[1], seed=SEED, jobs=nJobs, executor=EXECUTOR,
+             checkpoint=CHECKPOINT, resume=bool(args.resume)):
+    """! @brief Simulates one shard of a production."""
+    """! Each node of a production is given all the events and simulates only
+    its own shard (@ref shardRange). Merging the outputs of all the shards
+    with merge.py gives the same events of a single run with the same seed.
+
+    @param times List containing the photon times of all the events.
+
+    @param other Optional list containing the other informations of all the
+    events.
+
+    @param shard Index of the shard (starting from 0), by default the one
+    given with -S.
+
+    @param nshards Number of shards, by default the one given with -S.
+
+    @param seed Seed of the production, the same for all the shards. If None
+    (only for a single shard) the seed of the resumed checkpoint or a new
+    one from the operating system entropy pool is used.
+
+    @param jobs Number of workers.
+
+    @param executor Type of workers: "process" or "thread".
+
+    @param checkpoint Optional checkpoint directory of the shard.
+
+    @param resume If True the shard is resumed from its checkpoint directory.
+
+    @return results List containing the output of @ref SiPM for each event
+    of the shard.
+
+    @return info Dictionary describing the shard, to be passed to
+    @ref lib.SaveFile and @ref lib.SaveWaves.
+    """
+    if seed is None:
+        if nshards > 1:
+            # Shards of the same production must share the seed
+            raise ValueError('A seed is required to split the simulation in shards')
+        if checkpoint is not None and resume:
+            seed = checkpointSeed(checkpoint)
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), "big")
+    first, last = shardRange(len(times), shard, nshards)
+    if other is not None:
+        other = other[first:last]
+    results = runSimulation(times[first:last], other, seed, jobs, executor, first, checkpoint, resume)
+    info = {'Shard': shard, 'NShards': nshards, 'FirstEvent': first, 'NEvents': last - first,
+            'TotalEvents': len(times), 'Seed': seed, 'ChunkSize': CHUNKSIZE}
+    return results, info
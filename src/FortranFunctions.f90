@@ -21,6 +21,7 @@ pure subroutine fsignal(s, t, tf, tr, h, sigpts)
   integer(8)             :: i
 !f2py intent(in) t, h, gvar, tf, tr, sigpts
 !f2py intent(out) s
+!f2py threadsafe
 
   s = 0.
   forall (i = 1 : sigpts - t)
@@ -38,6 +39,7 @@ pure subroutine froll(out, vect, t, h, npt)
 !f2py intent(in) t, vect
 !f2py intent(hide), depend(vect) npt = vect.size
 !f2py intent(out) out
+!f2py threadsafe
 
   out = cshift(vect, -t, dim=1)
   out(1 : t) = 0
@@ -117,7 +119,7 @@ end subroutine normal
 subroutine poisson(out, mu, n)
   implicit none
   integer(8)     :: n, out(n)
-  real(8)        :: mu, L, p(n), u
+  real(8)        :: mu, L, p(n), u(n)
 !f2py intent(in) mu, n
 !f2py intent(out) out
 
@@ -152,6 +154,26 @@ subroutine exponential(out, mu, n)
   out = -log(out) * mu
 end subroutine exponential
 
+
+  !-------------------------------------------------------
+  !> @brief Seed of the random generator of the calling thread.
+  !
+  !> @param s Seed
+  !--------------------------------------------------------
+subroutine seed(s)
+  implicit none
+  integer(8)           :: s
+  integer              :: n, i
+  integer, allocatable :: put(:)
+!f2py intent(in) s
+
+  call random_seed(size=n)
+  allocate(put(n))
+  put = int(mod(s, 2147483647_8)) + 37 * [(i - 1, i = 1, n)]
+  call random_seed(put=put)
+  deallocate(put)
+end subroutine seed
+
 end module frandom
 
 
@@ -169,6 +191,7 @@ pure subroutine fsort(array,n)
   real(8)               :: temp, p, next
 !f2py intent(inout) array
 !f2py intent(hide), depend(array) n = len(array)
+!f2py threadsafe
 
   p = 0.5 * (array(1) + array(n))
   if (array(1) .gt. array(n)) then
@@ -4,8 +4,6 @@ import time
 NPE = 10
 NEVTS = 50000
 
-pool = multiprocessing.Pool(args.jobs, initializer=initializeRandomPool, initargs=(0,))
-
 times = []
 other = []
 
@@ -14,21 +12,20 @@ for i in range(NEVTS):
     times.append(np.abs(np.random.normal(20, 5, n)).tolist())
     other.append([])
 
-input = zip(times, other)c
-startingtime = time.time_ns()
-results = pool.starmap_async(SiPM, input)
-pool.close()
-pool.join()
-endingtime = time.time_ns()
+# Compare process and thread workers on the same events
+for executor in ('process', 'thread'):
+    startingtime = time.time_ns()
+    results = runSimulation(times, other, seed=0, jobs=nJobs, executor=executor)
+    endingtime = time.time_ns()
 
-elapsedtime = (endingtime - startingtime)
-eventsperms = NEVTS / (elapsedtime / 1e6)
-print(f'\nElapsed time: {elapsedtime / 1e6:.2f} ms [{elapsedtime / 1e9:.2f} s]')
-print(f'Simulation speed: {eventsperms:.3f} signals/ms [{1/eventsperms:.2f} ms per signal]')
+    elapsedtime = (endingtime - startingtime)
+    eventsperms = NEVTS / (elapsedtime / 1e6)
+    print(f'\n[{executor}] Elapsed time: {elapsedtime / 1e6:.2f} ms [{elapsedtime / 1e9:.2f} s]')
+    print(f'[{executor}] Simulation speed: {eventsperms:.3f} signals/ms [{1/eventsperms:.2f} ms per signal]')
 
 features = np.empty((NEVTS, 5), dtype='float')
 eventinfo = []
-for i, r in enumerate(results.get()):
+for i, r in enumerate(results):
     features[i, :] = r[0]
     eventinfo.append(r[1])
     signal = r[2]
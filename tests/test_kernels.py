@@ -0,0 +1,146 @@
+"""Equivalence tests of the backends of the kernels (libs/kernels.py).
+
+Run from the root of the repository with:
+    python -m pytest tests
+Backends that are not available on the host (Fortran module not built,
+Numba not installed) are skipped.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from libs import kernels
+
+BACKENDS = [pytest.param(name, marks=pytest.mark.skipif(kernels.loadBackend(name) is None,
+                                                        reason=f'{name} backend not available'))
+            for name in kernels.BACKENDORDER]
+
+
+@pytest.fixture
+def ref():
+    return kernels.loadBackend('numpy')
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+@pytest.mark.parametrize('t, h, sigpts', [(0, 1., 500), (7, 1.3, 1000), (499, 0.2, 500), (250, -2., 10000)])
+def test_fsignal(name, ref, t, h, sigpts):
+    k = kernels.loadBackend(name)
+    assert np.allclose(k.fsignal(t, 50., 1., h, sigpts), ref.fsignal(t, 50., 1., h, sigpts), rtol=1e-12, atol=0)
+
+
+def test_fsignal_shape(ref):
+    # Reference kernel against the closed form of the pulse shape
+    s = ref.fsignal(10, 50., 1., 2., 100)
+    i = np.arange(1, 91)
+    assert np.array_equal(s[:10], np.zeros(10))
+    assert np.allclose(s[10:], 2 * (np.exp(-i / 50.) - np.exp(-i / 1.)), rtol=1e-15, atol=0)
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+@pytest.mark.parametrize('t, h', [(0, 1.), (13, 0.7), (999, 3.)])
+def test_froll(name, ref, t, h):
+    k = kernels.loadBackend(name)
+    sig = ref.fsignal(0, 50., 1., 1., 1000)
+    assert np.allclose(k.froll(sig, t, h), ref.froll(sig, t, h), rtol=1e-15, atol=0)
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+@pytest.mark.parametrize('n', [1, 2, 17, 1000])
+def test_fsort(name, n):
+    k = kernels.loadBackend(name)
+    arr = np.random.default_rng(n).random(n)
+    arr[::3] = arr[0]   # Repeated values
+    assert np.array_equal(kernels.sortcopy(k, arr), np.sort(arr))
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_analysis(name, ref, seed):
+    k = kernels.loadBackend(name)
+    gate = np.random.default_rng(seed).normal(0, 1, 500) * (seed + 0.5)
+    assert np.allclose(k.signalanalysisfortran(gate, 0.1), ref.signalanalysisfortran(gate, 0.1),
+                       rtol=1e-12, atol=1e-12)
+
+
+def test_analysis_below_threshold(ref):
+    assert ref.signalanalysisfortran(np.zeros(10), 1.)[2] == 0
+
+
+def draws(k):
+    f = k.frandom
+    return np.concatenate([f.integer(9, 100), f.normal(1., 2., 100), f.poisson(0.3, 100), f.exponential(15., 100)])
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_seeded_streams(name):
+    k = kernels.loadBackend(name)
+    kernels.seedThread(12345)
+    a = draws(k)
+    kernels.seedThread(12345)
+    b = draws(k)
+    kernels.seedThread(54321)
+    c = draws(k)
+    assert np.array_equal(a, b)
+    assert not np.array_equal(a, c)
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_random_ranges(name):
+    k = kernels.loadBackend(name)
+    kernels.seedThread(7)
+    n = 200000
+    integers = k.frandom.integer(9, n)
+    assert integers.min() == 0 and integers.max() == 9
+    assert abs(integers.mean() - 4.5) < 0.05
+    assert abs(k.frandom.normal(1., 2., n).std() - 2) < 0.02
+    assert abs(k.frandom.poisson(0.3, n).mean() - 0.3) < 0.01
+    assert abs(k.frandom.exponential(15., n).mean() - 15) < 0.2
+
+
+def test_numba_uses_numpy_streams():
+    if kernels.loadBackend('numba') is None:
+        pytest.skip('numba backend not available')
+    kernels.seedThread(3)
+    a = draws(kernels.loadBackend('numpy'))
+    kernels.seedThread(3)
+    assert np.array_equal(a, draws(kernels.loadBackend('numba')))
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_thread_streams(name):
+    k = kernels.loadBackend(name)
+
+    def seeded(seed):
+        kernels.seedThread(seed)
+        return draws(k), threading.get_ident()
+
+    # Same seed gives the same stream in any thread
+    kernels.seedThread(1)
+    main = np.concatenate([draws(k), draws(k)])
+    kernels.seedThread(1)
+    first = draws(k)
+    with ThreadPoolExecutor(2) as pool:
+        other, tid = pool.submit(seeded, 1).result()
+        assert tid != threading.get_ident()
+        assert np.array_equal(other, first)
+        # Seeding another thread does not touch the stream of this one
+        pool.submit(seeded, 2).result()
+    assert np.array_equal(np.concatenate([first, draws(k)]), main)
+
+
+def test_thread_generators_differ():
+    with ThreadPoolExecutor(2) as pool:
+        barrier = threading.Barrier(2)
+
+        def fresh():
+            barrier.wait()  # Both threads alive at the same time
+            return kernels.generator().random(10)
+
+        a, b = pool.submit(fresh), pool.submit(fresh)
+        assert not np.array_equal(a.result(), b.result())
+
+
+def test_check_backends():
+    assert kernels.checkBackends()
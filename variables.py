@@ -44,6 +44,7 @@ global CELLRECOVERY  # Cell recovery time in ns
 global INTSTART  # Start of integration gate in ns
 global INTGATE  # Integration gate lenght in ns
 global PREG  # Lenght of pre-gate in ns
+global GATES  # Other gates (start in ns, lenght in ns, threshold in pe) analysed on each signal
 global SNR  # Signal to noise ratio in dB
 global BASESPREAD  # Baseline spread (sigma)
 global CCGV  # Cell to cell gain variation (sigma)
@@ -53,6 +54,40 @@ global TAUAPFAST  # After pulses time distribution decay (fast) in ns
 global TAUAPSLOW  # After pulses time distribution decay (slow) in ns
 global CPUTHRESHOLD  # If there are more pe than this value swich to GPU
 global GPUMAX  # If there are more pe than this value swich back to CPU
+global DISPATCH  # Choose the fastest signal generation strategy for each event
+global BACKEND  # Backend of the kernels (fortran, numba, numpy)
+global EXECUTOR  # Parallel execution with processes or threads
+global CHUNKSIZE  # Number of events simulated by a worker at once
+global CHECKPOINT  # Directory where completed chunks of events are stored
+global SEED  # Seed of the simulation (same for all the shards of a production)
+global SHARD  # Index of the shard simulated and number of shards of the production
+global NOISEBANK  # Sample noise from a precomputed bank instead of generating it
+global NOISEBANKSIZE  # Number of rows in each noise bank
+global NOISEBANKS  # Number of independent noise banks
+global NOISEFLIP  # Randomly flip sign and time direction of noise slices
+global NOISESEED  # Seed used to generate the noise banks
+global NOISEPSD  # File containing the noise power spectral density
+global BKGLIBRARY  # Mix dark counts from a pre-simulated background library
+global BKGSIZE  # Number of dark-only events in the background library
+global BKGSEED  # Seed used to generate the background library
+global MONITOR  # Show waveforms and statistics in a separate display process
+global MONITORFPS  # Frames sent by each worker to the display per second
+global MONITORSIZE  # Frames waiting to be displayed before new ones are dropped
+global SOCKET  # Unix socket of the simulation service
+global SERVICEBATCH  # Number of events simulated together by the service
+global SERVICEWAIT  # Time waited by the service to batch small requests in ms
+global SERVICEPENDING  # Requests of a client processed at once by the service
+global WAVECODEC  # Compression of the waveforms written on hdf5 files
+global CACHEDIR  # Directory where precomputed tables are stored
+global HITMAP  # File containing the illumination map of the sensor
+global SPOTSIGMA  # Sigma of the gaussian light spot in mm
+global SPOTX  # Horizontal offset of the light spot in mm
+global SPOTY  # Vertical offset of the light spot in mm
+global CELLMAP  # Fixed gain of each cell instead of a new gain for each pulse
+global CELLSEED  # Seed used to generate the maps of the cells
+global HOTCELLS  # Fraction of cells with higher dark count rate
+global HOTFACTOR  # Dark count rate of hot cells relative to the other cells
+global EVENTRATE  # Rate of the events, cells recover between consecutive events
 
 
 # Signal parameters
@@ -79,11 +114,52 @@ INTSTART = 10		# in ns
 INTGATE = 300		# in ns
 PREG = 0			# in ns
 THRESHOLD = 1.5     # in pe
+GATES = None        # e.g. [(10, 100, 1.5), (10, 300, 0.5)] (None = only the gate above)
+
+# Illumination parameters
+HITMAP = None       # File (.npy or txt) with the illumination map
+SPOTSIGMA = None    # in mm, gaussian spot (None = uniform)
+SPOTX = 0           # in mm from sensor center
+SPOTY = 0           # in mm from sensor center
+
+# Cells parameters
+CELLMAP = False     # Fixed gain of each cell (refer to libs/sensor file)
+CELLSEED = 0        # Seed of the cell maps
+HOTCELLS = 0.       # Fraction of hot cells (requires CELLMAP)
+HOTFACTOR = 100     # DCR of hot cells relative to the other cells
+EVENTRATE = None    # in Hz (None = independent events)
+
+# Noise parameters
+NOISEBANK = False   # Use a precomputed noise bank
+NOISEBANKSIZE = 1000  # Rows in each bank (each row holds two signals)
+NOISEBANKS = 1      # Number of independent banks
+NOISEFLIP = True    # Random sign and time reversal of noise slices
+NOISESEED = 0       # Seed of the noise banks
+NOISEPSD = None     # Two columns file: frequency in MHz, PSD (a.u.)
 
 # Simulation parameters
 FASTSIG = True
 CPUTHRESHOLD = 100
 GPUMAX = 2000
+DISPATCH = False    # Benchmark strategies and pick the fastest per event
+BACKEND = None      # fortran, numba, numpy (None = fastest available)
+EXECUTOR = 'process'  # process, thread
+CHUNKSIZE = 1000    # Events per task
+CHECKPOINT = None   # Directory for checkpoints (None = no checkpoints)
+SEED = None         # None = from entropy pool, required with --shard
+SHARD = (0, 1)      # (index, number of shards)
+BKGLIBRARY = False  # Use pre-simulated dark counts
+BKGSIZE = 10000     # Dark-only events in the library
+BKGSEED = 0         # Seed of the background library
+MONITOR = False     # Live monitor (refer to libs/monitor file)
+MONITORFPS = 10     # Frames per second per worker
+MONITORSIZE = 64    # Frames in the monitor queue
+SOCKET = '/tmp/pySiPM.sock'  # Used by service.py
+SERVICEBATCH = 100  # Events per batch
+SERVICEWAIT = 2     # in ms
+SERVICEPENDING = 16  # Requests per client before it stops being read
+WAVECODEC = 'gzip-9'  # gzip-1 ... gzip-9, lzf, none
+CACHEDIR = os.path.join(os.path.expanduser('~'), '.cache', 'pySiPM')
 
 
 # ARGUMENTSS PARSER
@@ -115,19 +191,50 @@ parser.add_argument('-w', '--write', nargs='?', type=str,
                     help='File to write as output', metavar='filename.root')
 parser.add_argument('-G', '--Graphics', action='store',
                     help='Plot each signal (For debug purposes only) specify interval in ms')
+parser.add_argument('-M', '--monitor', action='count',
+                    help='Live waveforms and statistics in a separate process (does not slow down the simulation)')
 parser.add_argument('-j', '--jobs', type=int,
                     help='Number of jobs for multiprocessing', metavar='N')
+parser.add_argument('-x', '--executor', type=str,
+                    help='Run jobs in separate processes or in threads sharing memory',
+                    choices=['process', 'thread'])
+parser.add_argument('-S', '--shard', nargs=2, type=int,
+                    help='Simulate only the I-th of N shards of the events',
+                    metavar=('I', 'N'))
+parser.add_argument('-C', '--checkpoint', nargs='?', type=str,
+                    help='Store completed chunks of events in a directory', metavar='directory')
+parser.add_argument('--resume', action='count',
+                    help='Resume an interrupted simulation from its checkpoint directory')
+parser.add_argument('-s', '--seed', type=int,
+                    help='Seed of the simulation', metavar='seed')
 parser.add_argument('-NDCR', '--nodcr', action='count',
                     help='Set DCR rate to 0')
 parser.add_argument('-NXT', '--noxt', action='count', help='Set XT rate to 0')
 parser.add_argument('-NAP', '--noap', action='count', help='Set AP rate to 0')
+parser.add_argument('-BKG', '--background', action='count',
+                    help='Mix dark counts from a pre-simulated background library')
+parser.add_argument('-CM', '--cellmap', action='count',
+                    help='Fixed gain and dark count rate of each cell')
 parser.add_argument('-SIG', '--signal', action='count',
                     help='Generate each signal independently (slower)')
+parser.add_argument('-B', '--backend', type=str,
+                    help='Backend of the kernels (fastest available by default)',
+                    choices=['fortran', 'numba', 'numpy'])
+parser.add_argument('-AUTO', '--dispatch', action='count',
+                    help='Benchmark signal generation strategies and use the fastest for each event')
 parser.add_argument('-f', '--fname', nargs='?', type=str,
                     help='Configuration file', metavar='filename.txt')
+parser.add_argument('-NB', '--noisebank', action='count',
+                    help='Sample noise from a precomputed noise bank (faster)')
 parser.add_argument('-W', '--wavedump', nargs='?', type=str,
                     help='Output Digitized Waveforms on hdf5 file',
                     metavar='filename')
+parser.add_argument('-R', '--replay', nargs='?', type=str,
+                    help='Output pulse lists on hdf5 file (waveforms can be generated again from them)',
+                    metavar='filename')
+parser.add_argument('--socket', nargs='?', type=str,
+                    help='Unix socket of the simulation service (service.py)',
+                    metavar='path')
 # parser.add_argument('-T', '--txtfile', nargs='?', type=str,
 #                     help='Input of txt file', metavar='groupname')
 
@@ -163,9 +270,45 @@ else:
     # Use settings defined above
     print('\nUsing default SiPM settings!\n')
 
+if args.noisebank:
+    NOISEBANK = True
+if args.background:
+    BKGLIBRARY = True
+if args.dispatch:
+    DISPATCH = True
+if args.cellmap:
+    CELLMAP = True
+if args.monitor:
+    MONITOR = True
+if args.backend:
+    BACKEND = args.backend
+if args.executor:
+    EXECUTOR = args.executor
+if args.socket:
+    SOCKET = args.socket
+if args.seed is not None:
+    SEED = args.seed
+if args.checkpoint:
+    CHECKPOINT = args.checkpoint
+if args.resume and CHECKPOINT is None:
+    raise ValueError('A checkpoint directory (-C) is required to resume a simulation')
+if args.shard:
+    SHARD = tuple(args.shard)
+if SHARD != (0, 1):
+    if not 0 <= SHARD[0] < SHARD[1]:
+        raise ValueError(f'Shard index {SHARD[0]:d} out of range for {SHARD[1]:d} shards')
+    if SEED is None:
+        # Shards of the same production must share the seed
+        raise ValueError('A seed (-s) is required to split the simulation in shards')
+if NOISEPSD is not None:
+    # Coloured noise is only available from the noise bank
+    NOISEBANK = True
+
 print('Detected %d cores...\r' % (multiprocessing.cpu_count()))
-print('Initializing simulation on %d cores...\n' % (nJobs))
-if args.signal is None:
+print('Initializing simulation on %d cores (%s)...\n' % (nJobs, EXECUTOR))
+if DISPATCH:
+    print('Generating signals with the fastest strategy for each event...')
+elif args.signal is None:
     print('Generating signals with the fast method on CPU (default)...')
 
 if args.signal:
@@ -176,6 +319,40 @@ if args.signal:
         if args.device == 'gpu':
             warnings.warn('Signal generation on GPU is deprecated... use CPU preferably', category=DeprecationWarning, stacklevel=3)
 
+if SHARD != (0, 1):
+    print(f'Simulating shard {SHARD[0]:d} of {SHARD[1]:d} with seed {SEED:d}...')
+
+if CHECKPOINT is not None:
+    print(f'{"Resuming from" if args.resume else "Storing"} checkpoints in: {CHECKPOINT:s}')
+
+if BKGLIBRARY and not args.nodcr:
+    print(f'Mixing dark counts from background library of {BKGSIZE:d} events...')
+
+if HITMAP is not None:
+    print(f'Reading illumination map from: {HITMAP:s}')
+elif SPOTSIGMA is not None:
+    print(f'Illuminating a gaussian spot of {SPOTSIGMA:.2f} mm at ({SPOTX:.2f}, {SPOTY:.2f}) mm')
+
+if CELLMAP:
+    print(f'Using fixed cell maps with seed {CELLSEED:d} ({HOTCELLS:.2%} hot cells)...')
+elif HOTCELLS:
+    warnings.warn('Hot cells are only simulated with fixed cell maps (-CM)', category=UserWarning)
+if EVENTRATE is not None:
+    print(f'Cells recover between consecutive events at {EVENTRATE:.3g} Hz...')
+    if 1e9 / EVENTRATE < SIGLEN:
+        warnings.warn(f'Events at {EVENTRATE:.3g} Hz overlap in the signal window of {SIGLEN:.0f} ns',
+                      category=UserWarning)
+
+if GATES:
+    print(f'Analysing {len(GATES):d} additional gates on each signal...')
+
+if NOISEBANK:
+    if NOISEPSD is None:
+        print('Sampling white noise from precomputed noise bank...')
+    else:
+        print(f'Sampling coloured noise from precomputed noise bank (PSD: {NOISEPSD:s})...')
+    print(f'Noise bank holds {2 * NOISEBANKS * NOISEBANKSIZE:d} independent slices, events share them beyond that')
+
 # NOT EDITABLE VARIABLES
 # Performing conversion of time units from ns to
 # units of sampling times and basic calculations.
@@ -188,6 +365,16 @@ if INTGATE + INTSTART > SIGLEN:
                   category=UserWarning)
     INTGATE = SIGLEN - INTSTART
 INTSTART = int(INTSTART / SAMPLING)
+if GATES:
+    for start, gate, thr in GATES:
+        if not 0 <= start < SIGLEN:
+            raise ValueError(f'Gate starting at {start:.0f} ns is outside the signal window of {SIGLEN:.0f} ns')
+        if int(min(gate, SIGLEN - start) / SAMPLING) < 1:
+            raise ValueError(f'Gate of {gate:.2f} ns starting at {start:.0f} ns is shorter than one sample')
+        if gate + start > SIGLEN:
+            warnings.warn(f'Gate of {gate:.0f} ns starting at {start:.0f} ns exeeds signal length of {SIGLEN:.0f} ns',
+                          category=UserWarning)
+    GATES = [(int(start / SAMPLING), int(min(gate, SIGLEN - start) / SAMPLING), thr) for start, gate, thr in GATES]
 INTGATE = int(INTGATE / SAMPLING)
 PREG = int(INTSTART - PREG / SAMPLING)
 PEAKRATIO = -exp(TFALL*np.log(TRISE/TFALL)/(TFALL - TRISE)) + exp(TRISE*np.log(TRISE/TFALL)/(TFALL - TRISE))
@@ -196,3 +383,10 @@ SNR = 10**(-SNR / 20)
 
 TF = TFALL / SAMPLING
 TR = TRISE / SAMPLING
+
+# Kernels used by the simulation (refer to libs/kernels file)
+from libs.kernels import loadBackend
+kernels = loadBackend(BACKEND)
+if kernels is None:
+    raise ImportError(f'Backend {BACKEND:s} is not available on this host')
+print(f'Using {kernels.name:s} kernels\n')